@@ -0,0 +1,54 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Access to the StratusLab services used by the driver.
+
+ The driver never creates StratusLab clients directly; it asks its
+ backend for them.  The DirectBackend defined here talks to the real
+ services.  Other backends (see the recording module) wrap or replace
+ it, for example to record and replay the traffic of the driver.
+
+ A backend provides the following methods.  The location_id is the
+ id of the location the client is created for.
+
+   create_monitor(location_id, config_holder)
+   create_volume_manager(location_id, config_holder)
+   create_vm_manager(location_id, image_id, config_holder)
+   open_url(location_id, url) -> file-like object
+
+"""
+
+import urllib
+
+from stratuslab.Monitor import Monitor
+from stratuslab.volume_manager.volume_manager_factory import VolumeManagerFactory
+from stratuslab.vm_manager.vm_manager_factory import VmManagerFactory
+
+
+class DirectBackend(object):
+    """Backend using the real StratusLab services."""
+
+    def create_monitor(self, location_id, config_holder):
+        return Monitor(config_holder)
+
+    def create_volume_manager(self, location_id, config_holder):
+        return VolumeManagerFactory.create(config_holder)
+
+    def create_vm_manager(self, location_id, image_id, config_holder):
+        return VmManagerFactory.create(image_id, config_holder)
+
+    def open_url(self, location_id, url):
+        return urllib.urlopen(url)
@@ -29,13 +29,15 @@ Driver for StratusLab (http://stratuslab.eu) cloud infrastructures.
 """
 
 import xml.etree.ElementTree as ET
+import bisect
 import ConfigParser as ConfigParser
-import urllib
+import logging
 import uuid
 import tempfile
 import os
+import threading
+import time
 
-from stratuslab.Monitor import Monitor
 from stratuslab.ConfigHolder import ConfigHolder, UserConfigurator
 import stratuslab.Util as StratusLabUtil
 from libcloud.compute.base import NodeImage, NodeSize, Node
@@ -44,10 +46,21 @@ from libcloud.compute.base import NodeLocation, UuidMixin
 from libcloud.compute.base import StorageVolume
 from libcloud.compute.types import NodeState
 
-from stratuslab.volume_manager.volume_manager_factory import VolumeManagerFactory
-
 from stratuslab.vm_manager.vm_manager import VmManager
-from stratuslab.vm_manager.vm_manager_factory import VmManagerFactory
+
+from stratuslab.libcloud.backend import DirectBackend
+from stratuslab.libcloud.executor import ThreadPool, map_grouped, wait_all
+from stratuslab.libcloud.inventory_store import InventoryPoller, InventoryStore
+from stratuslab.libcloud.inventory_store import VOLUMES
+from stratuslab.libcloud.marketplace_snapshot import MarketplaceSnapshot
+from stratuslab.libcloud.marketplace_snapshot import write_snapshot
+from stratuslab.libcloud.recording import RecordingBackend, ReplayBackend
+from stratuslab.libcloud.resilience import CircuitOpenError
+from stratuslab.libcloud.resilience import ResiliencePolicy, RetryBudget
+from stratuslab.libcloud.singleflight import SingleFlight
+from stratuslab.libcloud.warm_pool import WarmPool
+
+log = logging.getLogger(__name__)
 
 
 class StratusLabNodeSize(NodeSize):
@@ -75,15 +88,26 @@ class StratusLabNode(Node, UuidMixin):
     Subclass of the standard Node class that uses a function to
     lookup the state of the node.  Although a setter for the state
     is defined, the value is ignored.
+
+    The public IP addresses of a node created with deferred network
+    resolution are filled in by a background call.  Reading
+    public_ips waits for that call (repr() does not; it shows the
+    addresses as pending); network_future can be used to wait with a
+    timeout or to register a callback.
     """
 
     def __init__(self, node_id, name, state, public_ips, private_ips,
-                 driver, size=None, image=None, extra=None):
+                 driver, size=None, image=None, extra=None,
+                 network_future=None):
 
         super(StratusLabNode, self).__init__(node_id, name, state,
                                              public_ips, private_ips,
                                              driver, size, image, extra)
 
+        self.network_future = network_future
+        if network_future is not None:
+            network_future.add_done_callback(self._apply_network_detail)
+
         try:
             self.location = extra['location']
         except (TypeError, KeyError):
@@ -97,6 +121,59 @@ class StratusLabNode(Node, UuidMixin):
     def state(self, value):
         self.cached_state = value
 
+    def __repr__(self):
+        # unlike Node.__repr__, do not wait for a deferred network lookup
+        future = getattr(self, 'network_future', None)
+        if future is not None and not future.done():
+            public_ips = '<pending>'
+        else:
+            public_ips = self.public_ips
+        return (('<Node: uuid=%s, name=%s, state=%s, public_ips=%s, '
+                 'private_ips=%s, provider=%s ...>')
+                % (self.uuid, self.name, self.state, public_ips,
+                   self.private_ips, self.driver.name))
+
+    @property
+    def public_ips(self):
+        future = getattr(self, 'network_future', None)
+        if future is not None:
+            future.wait()
+            self._apply_network_detail(future)
+        return self._public_ips
+
+    @public_ips.setter
+    def public_ips(self, value):
+        self._public_ips = value
+
+    def _apply_network_detail(self, future):
+        # Called from the callback and from readers, which may run
+        # before the callback.  Applying the result twice is harmless;
+        # once it is applied, later assignments to public_ips stick.
+        if getattr(self, '_network_applied', False):
+            return
+
+        error = future.exception()
+        if error is None:
+            _, ip = future.result()
+            self._public_ips = [ip]
+        else:
+            log.warning('cannot recover network details of node %s: %s',
+                        self.id, error)
+
+        self._network_applied = True
+
+    def wait_for_public_ips(self, timeout=None):
+        """
+        Waits at most timeout seconds (forever if None) for the
+        public IP addresses of the node and returns them.  Raises the
+        error of the network lookup if it failed, or TimeoutError.
+
+        """
+
+        if self.network_future is not None:
+            self.network_future.result(timeout)
+        return self.public_ips
+
     @property
     def host(self):
         vm_info = self.get_vm_info()
@@ -110,12 +187,7 @@ class StratusLabNode(Node, UuidMixin):
         return host
 
     def get_vm_info(self):
-        config_holder = \
-            StratusLabNodeDriver.get_config_section(self.location,
-                                                    self.driver.user_configurator)
-        monitor = Monitor(config_holder)
-
-        vm_infos = monitor.vmDetail([self.id])
+        vm_infos = self.driver._get_vm_detail(self.location, self.id)
         if len(vm_infos) == 0:
             raise ValueError('cannot recover state information for %s' % self.id)
 
@@ -135,7 +207,20 @@ class StratusLabNode(Node, UuidMixin):
 
 
 class StratusLabNodeDriver(NodeDriver):
-    """StratusLab node driver."""
+    """
+    StratusLab node driver.
+
+    A single driver instance may be shared between threads.  The
+    user configuration is parsed once, when the driver is created,
+    and is not modified afterwards; each call works on its own copy
+    of the configuration for the selected location.  Monitor and
+    pdisk clients are cached per thread and per location, so that
+    threads never share a backend connection.  VM runners depend on
+    the requested name, size, and image and are created per call.
+
+    The locations, sizes, and images returned by the driver are
+    shared and are not intended to be modified by the user.
+    """
 
     RDF_RDF = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}RDF'
     RDF_DESCRIPTION = '{http://www.w3.org/1999/02/22-rdf-syntax-ns#}Description'
@@ -145,11 +230,6 @@ class StratusLabNodeDriver(NodeDriver):
 
     DEFAULT_MARKETPLACE_URL = 'https://marketplace.stratuslab.eu'
 
-    user_configurator = None
-    locations = None
-    default_location = None
-    sizes = None
-
     def __init__(self, key, secret=None, secure=False, host=None, port=None,
                  api_version=None, **kwargs):
         """
@@ -178,6 +258,67 @@ class StratusLabNodeDriver(NodeDriver):
         the section within the user configuration file to use as the
         default location.
 
+        :keyword stratuslab_call_timeout (float): Deadline in seconds
+        for each backend query (default 60); 0 disables the deadline.
+
+        :keyword stratuslab_max_retries (int): Maximum number of
+        retries of a failed backend query (default 2).  Operations
+        that change the state of the cloud are never retried.
+
+        :keyword stratuslab_breaker_threshold (int): Number of
+        consecutive failures after which calls to a location fail
+        fast (default 5).
+
+        :keyword stratuslab_breaker_reset (float): Number of seconds
+        after which a location with an open circuit is probed again
+        (default 30).
+
+        :keyword stratuslab_mutation_timeout (float): Deadline in
+        seconds for the calls that change the state of the cloud
+        (creating and destroying machines and volumes, attaching and
+        detaching volumes).  The default, 0, waits until they finish.
+        When the deadline expires the call may still succeed, and
+        OutcomeUnknownError is raised instead of a failure.
+
+        The last five values may be overridden per location with the
+        'call_timeout', 'max_retries', 'breaker_threshold',
+        'breaker_reset', and 'mutation_timeout' keys of the
+        corresponding configuration section.
+
+        :keyword stratuslab_size_registry (SizeRegistry): Registry
+        through which drivers with the same instance type definitions
+        share the parsed instance type table (see driver_cache).
+
+        :keyword stratuslab_backend: Backend providing the StratusLab
+        clients (see the backend module).  Defaults to the real
+        services.
+
+        :keyword stratuslab_record (str): Name of a file in which all
+        of the backend traffic is recorded (see the recording module).
+
+        :keyword stratuslab_replay (str): Name of a recording from
+        which the backend traffic is replayed instead of contacting
+        the services.
+
+        :keyword stratuslab_replay_speed (float): Factor applied to
+        the recorded latencies during replay (default 1.0); 0 replays
+        without delays.
+
+        :keyword stratuslab_defer_network (bool): Default value of the
+        defer_network keyword of create_node (default False).
+
+        :keyword stratuslab_inventory_store (str): Name of a SQLite
+        file shared by the processes of a deployment, from which the
+        machines and volumes are read while they are fresh enough
+        (see the inventory_store module).
+
+        :keyword stratuslab_inventory_max_age (float): Maximum age in
+        seconds of the inventory data that is used (default 30).
+
+        :keyword stratuslab_inventory_poll_interval (float): Interval
+        in seconds at which the elected process refreshes the
+        inventory (default 10); 0 means that this driver never polls.
+
         :returns: StratusLabNodeDriver
 
         """
@@ -202,10 +343,67 @@ class StratusLabNodeDriver(NodeDriver):
 
         self.user_configurator = UserConfigurator(configFile=user_config_file)
 
+        self.backend = self._create_backend(kwargs)
+
         self.default_location, self.locations = \
             self._get_config_locations(default_section)
 
-        self.sizes = self._get_config_sizes()
+        self._section_configs = self._get_config_section_dicts()
+        self._section_configs_lock = threading.Lock()
+
+        size_registry = kwargs.get('stratuslab_size_registry', None)
+        if size_registry is None:
+            instance_types = self._get_config_instance_types()
+        else:
+            user_types = self.user_configurator.getUserDefinedInstanceTypes()
+            instance_types = size_registry.get_instance_types(user_types,
+                                                              self._get_config_instance_types)
+        self._set_sizes([self._create_node_size(name, resources)
+                         for name, resources in instance_types.items()])
+
+        self._single_flight = SingleFlight()
+        self._thread_clients = threading.local()
+
+        self._pool = ThreadPool(name='stratuslab-driver')
+        self._retry_budget = RetryBudget()
+        self._policy_defaults = {
+            'callTimeout': kwargs.get('stratuslab_call_timeout', 60),
+            'maxRetries': kwargs.get('stratuslab_max_retries', 2),
+            'breakerThreshold': kwargs.get('stratuslab_breaker_threshold', 5),
+            'breakerReset': kwargs.get('stratuslab_breaker_reset', 30),
+            'mutationTimeout': kwargs.get('stratuslab_mutation_timeout', 0)}
+        self._policies = {}
+        self._policies_lock = threading.Lock()
+
+        self.warm_pool = None
+        self.defer_network = kwargs.get('stratuslab_defer_network', False)
+
+        self.inventory = None
+        self.inventory_poller = None
+        inventory_file = kwargs.get('stratuslab_inventory_store', None)
+        if inventory_file:
+            max_age = kwargs.get('stratuslab_inventory_max_age', 30)
+            self.inventory = InventoryStore(inventory_file, max_age=max_age)
+            interval = kwargs.get('stratuslab_inventory_poll_interval', 10)
+            if interval:
+                self.inventory_poller = InventoryPoller(self, self.inventory,
+                                                        interval=interval)
+                self.inventory_poller.start()
+
+    @staticmethod
+    def _create_backend(kwargs):
+        backend = kwargs.get('stratuslab_backend', None) or DirectBackend()
+
+        replay_file = kwargs.get('stratuslab_replay', None)
+        if replay_file:
+            speed = kwargs.get('stratuslab_replay_speed', 1.0)
+            return ReplayBackend(replay_file, speed=speed)
+
+        record_file = kwargs.get('stratuslab_record', None)
+        if record_file:
+            return RecordingBackend(record_file, backend=backend)
+
+        return backend
 
     # noinspection PyUnusedLocal
     def get_uuid(self, unique_field=None):
@@ -227,7 +425,12 @@ class StratusLabNodeDriver(NodeDriver):
         config = UserConfigurator.userConfiguratorToDictWithFormattedKeys(user_configurator,
                                                                           selected_section=selected_section)
 
-        options = options or {}
+        return StratusLabNodeDriver._create_config_holder(dict(config),
+                                                          options)
+
+    @staticmethod
+    def _create_config_holder(config, options=None):
+        options = dict(options or {})
         options['verboseLevel'] = -1
         options['verbose_level'] = -1
 
@@ -237,10 +440,155 @@ class StratusLabNodeDriver(NodeDriver):
         return config_holder
 
     def _get_config_section(self, location, options=None):
+        """
+        Returns a new ConfigHolder for the given location (or the
+        default location).  The configuration is copied from the
+        dictionaries parsed when the driver was created, so callers
+        are free to modify the returned holder.
+
+        """
+
+        location = location or self.default_location
+
+        config = self._section_configs.get(location.id)
+        if config is None:
+            # UserConfigurator.getDict() modifies the configurator, so
+            # sections not seen at creation time are parsed under a lock.
+            with self._section_configs_lock:
+                config = UserConfigurator.userConfiguratorToDictWithFormattedKeys(self.user_configurator,
+                                                                                  selected_section=location.id)
+                config = dict(config)
+
+        return StratusLabNodeDriver._create_config_holder(dict(config),
+                                                          options)
+
+    def _get_config_section_dicts(self):
+        """
+        Parses the configuration of every location once and returns
+        a dictionary of formatted configuration dictionaries keyed by
+        location id.  The dictionaries are never modified afterwards.
+
+        """
+
+        configs = {}
+        for location_id in self._all_location_ids():
+            config = UserConfigurator.userConfiguratorToDictWithFormattedKeys(self.user_configurator,
+                                                                              selected_section=location_id)
+            configs[location_id] = dict(config)
+        return configs
+
+    def _all_location_ids(self):
+        location_ids = list(self.locations.keys())
+        if self.default_location.id not in location_ids:
+            location_ids.append(self.default_location.id)
+        return location_ids
+
+    def _get_thread_client(self, kind, location, factory):
+        """
+        Returns the backend client of the given kind for the location,
+        creating it with factory(location_id, config_holder) if the
+        current thread does not have one yet.  Clients are never
+        shared between threads.
+
+        """
+
+        location = location or self.default_location
+
+        clients = getattr(self._thread_clients, 'clients', None)
+        if clients is None:
+            clients = {}
+            self._thread_clients.clients = clients
+
+        key = (kind, location.id)
+        client = clients.get(key)
+        if client is None:
+            client = factory(location.id, self._get_config_section(location))
+            clients[key] = client
+        return client
+
+    def _get_monitor(self, location):
+        return self._get_thread_client('monitor', location,
+                                       self.backend.create_monitor)
+
+    def _get_pdisk(self, location):
+        return self._get_thread_client('pdisk', location,
+                                       self.backend.create_volume_manager)
+
+    def _get_policy(self, location):
+        """
+        Returns the resilience policy (deadline, retries, and circuit
+        breaker) of the given location, creating it on first use.
+
+        """
+
         location = location or self.default_location
-        return StratusLabNodeDriver.get_config_section(location,
-                                                       self.user_configurator,
-                                                       options)
+
+        with self._policies_lock:
+            policy = self._policies.get(location.id)
+            if policy is None:
+                policy = self._create_policy(location)
+                self._policies[location.id] = policy
+            return policy
+
+    def _create_policy(self, location):
+        config = self._section_configs.get(location.id, {})
+
+        def value(key, convert):
+            return convert(config.get(key, self._policy_defaults[key]))
+
+        return ResiliencePolicy(location.id,
+                                self._pool,
+                                self._retry_budget,
+                                timeout=value('callTimeout', float),
+                                max_retries=value('maxRetries', int),
+                                failure_threshold=value('breakerThreshold', int),
+                                reset_timeout=value('breakerReset', float),
+                                mutation_timeout=value('mutationTimeout', float))
+
+    def _coalesced_call(self, operation, location, fn, *args):
+        """
+        Calls fn(location, *args) under the resilience policy of the
+        location, unless an identical call is already in flight from
+        another thread, in which case the result of that call is
+        shared.  Calls are identical when they have the same
+        operation, location, and arguments.  Only queries (calls
+        without side effects) may be made with this method.
+
+        """
+
+        location = location or self.default_location
+        key = (operation, location.id, args)
+        policy = self._get_policy(location)
+        return self._single_flight.do(key, policy.call, fn, location, *args)
+
+    def _call_once(self, location, fn, *args):
+        """
+        Calls fn(location, *args) under the mutation deadline and
+        circuit breaker of the location, without retries.  Used for
+        calls that change the state of the cloud.
+
+        """
+
+        location = location or self.default_location
+        return self._get_policy(location).call_once(fn, location, *args)
+
+    def _pdisk_call(self, location, method, *args):
+        # The pdisk client is looked up in the thread making the call,
+        # which may be a worker thread when a deadline is used.
+        return getattr(self._get_pdisk(location), method)(*args)
+
+    def get_coalescing_stats(self):
+        """
+        Returns a dictionary describing the coalescing of concurrent
+        backend queries: the total number of queries ('calls'), the
+        number that shared the result of an identical in-flight query
+        ('coalesced'), and the number currently in flight
+        ('in_flight').
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+        return self._single_flight.stats()
 
     def _get_config_locations(self, default_section=None):
         """
@@ -304,25 +652,69 @@ class StratusLabNodeDriver(NodeDriver):
 
         return default_location, locations
 
-    def _get_config_sizes(self):
+    def _get_config_instance_types(self):
+        """
+        Returns the resources (cpu, ram, swap) of all of the instance
+        types, keyed by name: the default types updated with the ones
+        defined in the user configuration.
+
+        """
+
+        instance_types = dict(VmManager.getDefaultInstanceTypes())
+        instance_types.update(self.user_configurator.getUserDefinedInstanceTypes())
+        return instance_types
+
+    def _set_sizes(self, sizes):
         """
-        Create all of the node sizes based on the user configuration.
+        Sets the node sizes and rebuilds the indexes used by
+        get_size(), find_best_size(), and _vm_info_to_node().  The
+        indexes are only rebuilt here, when the configured sizes
+        change.
 
         """
 
         size_map = {}
+        shape_index = []
+        for size in sizes:
+            size_map[size.id] = size
+            shape_index.append((size.cpu, size.ram, size.disk, size.id))
+        shape_index.sort()
+
+        sizes_by_shape = {}
+        for cpu, ram, disk, size_id in shape_index:
+            sizes_by_shape.setdefault((cpu, ram, disk), size_map[size_id])
+
+        # Replace the whole set of attributes at once; readers in
+        # other threads never see a partially built index.
+        self._size_map, self._shape_index, self._sizes_by_shape, self.sizes = \
+            size_map, shape_index, sizes_by_shape, sizes
+
+    def get_size(self, name):
+        """
+        Returns the node size with the given id (name) or None if no
+        such size is defined.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+        return self._size_map.get(name)
 
-        machine_types = VmManager.getDefaultInstanceTypes()
-        for name in machine_types.keys():
-            size = self._create_node_size(name, machine_types[name])
-            size_map[name] = size
+    def find_best_size(self, cpu=1, ram=0, disk=0):
+        """
+        Returns the smallest node size with at least the given number
+        of CPUs, RAM (MB), and disk (MB), or None if no size is large
+        enough.  Sizes are ordered by CPU, then RAM, then disk.
 
-        machine_types = self.user_configurator.getUserDefinedInstanceTypes()
-        for name in machine_types.keys():
-            size = self._create_node_size(name, machine_types[name])
-            size_map[name] = size
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
 
-        return size_map.values()
+        shape_index = self._shape_index
+        start = bisect.bisect_left(shape_index, (cpu,))
+        for size_cpu, size_ram, size_disk, size_id in shape_index[start:]:
+            if size_ram >= ram and size_disk >= disk:
+                return self._size_map[size_id]
+        return None
 
     def _create_node_size(self, name, resources):
         cpu, ram, swap = resources
@@ -342,13 +734,61 @@ class StratusLabNodeDriver(NodeDriver):
         List the nodes (machine instances) that are active in all
         locations.
 
+        Locations with an open circuit are skipped and logged, unless
+        all of them are.  Any other failure is raised; use
+        list_nodes_with_failures() to get the nodes of the locations
+        that could be queried.
+
         """
 
-        nodes = []
-        for location in self.locations.values():
-            nodes.extend(self.list_nodes_in_location(location))
+        nodes, failures = self.list_nodes_with_failures()
+
+        for location_id in sorted(failures):
+            if not isinstance(failures[location_id], CircuitOpenError):
+                raise failures[location_id]
+
+        if failures and len(failures) == len(self.locations):
+            raise failures.values()[0]
+
         return nodes
 
+    def list_nodes_with_failures(self):
+        """
+        List the nodes in all locations, querying the locations in
+        parallel.  Returns a tuple with the list of nodes and a
+        dictionary mapping the ids of the locations that could not be
+        queried to the corresponding exception.  Locations with an
+        open circuit are not contacted at all.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+
+        failures = {}
+
+        locations = []
+        for location in self.locations.values():
+            if self._get_policy(location).breaker.is_open():
+                failures[location.id] = \
+                    CircuitOpenError('circuit open for location %s' % location.id)
+            else:
+                locations.append(location)
+
+        futures = self._pool.map(self.list_nodes_in_location, locations)
+
+        nodes = []
+        for location, (result, error) in zip(locations, wait_all(futures)):
+            if error is None:
+                nodes.extend(result)
+            else:
+                failures[location.id] = error
+
+        for location_id, error in failures.items():
+            log.warning('skipped location %s in list_nodes: %s',
+                        location_id, error)
+
+        return nodes, failures
+
     def list_nodes_in_location(self, location):
         """
         List the nodes (machine instances) that are active in the
@@ -356,10 +796,7 @@ class StratusLabNodeDriver(NodeDriver):
 
         """
 
-        config_holder = self._get_config_section(location)
-
-        monitor = Monitor(config_holder)
-        vms = monitor.listVms()
+        vms = self.list_vm_infos(location)
 
         nodes = []
         for vm_info in vms:
@@ -367,6 +804,57 @@ class StratusLabNodeDriver(NodeDriver):
 
         return nodes
 
+    def list_vm_infos(self, location):
+        """
+        Returns the raw StratusLab information (CloudInfo objects) for
+        the machine instances in the given location.  Unlike nodes,
+        these contain all of the attributes (including the host)
+        without further backend calls.  The returned objects are
+        shared and must not be modified.
+
+        When an inventory store is configured, the information comes
+        from the store if it is fresh enough.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+        if self.inventory is not None:
+            vm_infos = self.inventory.get_vms(location.id)
+            if vm_infos is not None:
+                return vm_infos
+
+        listed, vm_infos = self._list_vm_infos_stamped(location)
+
+        if self.inventory is not None:
+            self.inventory.put_vms(location.id, vm_infos, listed)
+
+        return vm_infos
+
+    def _list_vm_infos_live(self, location):
+        return self._list_vm_infos_stamped(location)[1]
+
+    def _list_vm_infos_stamped(self, location):
+        # Returns (start time, vm infos).  Callers that join a listing
+        # already in flight get the start time of that listing.
+        return self._coalesced_call('listVms', location, self._list_vms)
+
+    def _list_vms(self, location):
+        started = time.time()
+        return started, self._get_monitor(location).listVms()
+
+    def _get_vm_detail(self, location, node_id):
+        if self.inventory is not None:
+            location_id = (location or self.default_location).id
+            vm_info = self.inventory.get_vm(location_id, node_id)
+            if vm_info is not None:
+                return [vm_info]
+
+        return self._coalesced_call('vmDetail', location,
+                                    self._vm_detail, node_id)
+
+    def _vm_detail(self, location, node_id):
+        return self._get_monitor(location).vmDetail([node_id])
+
     def _vm_info_to_node(self, vm_info, location):
         attrs = vm_info.getAttributes()
         node_id = attrs['id'] or None
@@ -379,13 +867,14 @@ class StratusLabNodeDriver(NodeDriver):
         else:
             public_ips = []
 
-        size_name = '%s_size' % node_id
-
         cpu = attrs['template_cpu']
         ram = attrs['template_memory']
         swap = attrs['template_disk_size']
 
-        size = self._create_node_size(size_name, (cpu, ram, swap))
+        size = self._size_for_shape(cpu, ram, swap)
+        if size is None:
+            size_name = '%s_size' % node_id
+            size = self._create_node_size(size_name, (cpu, ram, swap))
 
         mp_url = attrs['template_disk_source']
         mp_id = mp_url.split('/')[-1]
@@ -401,6 +890,19 @@ class StratusLabNodeDriver(NodeDriver):
                               image=image,
                               extra={'location': location})
 
+    def _size_for_shape(self, cpu, ram, swap):
+        """
+        Returns the named node size matching the resources of a
+        running machine, or None if there is no such size.
+
+        """
+
+        try:
+            shape = (int(cpu), int(ram), int(swap))
+        except (TypeError, ValueError):
+            return None
+        return self._sizes_by_shape.get(shape)
+
     @staticmethod
     def _to_node_state(state):
         if state:
@@ -436,6 +938,17 @@ class StratusLabNodeDriver(NodeDriver):
                             (optional)
         @type       auth:   L{NodeAuthSSHKey} or L{NodeAuthPassword}
 
+        @keyword    defer_network: Return as soon as the machine has
+                                   been submitted and look up its
+                                   public IP address in the background
+                                   (optional, default set by the
+                                   driver)
+        @type       defer_network: C{bool}
+
+        When a warm pool is enabled (see enable_warm_pool) and has a
+        running spare matching the location, image, size, and
+        authentication, that node is returned immediately.
+
         @return: The newly created node.
         @rtype: L{StratusLabNode}
 
@@ -443,20 +956,46 @@ class StratusLabNodeDriver(NodeDriver):
 
         """
 
+        if self.warm_pool is not None:
+            node = self.warm_pool.acquire(kwargs.get('location'),
+                                          kwargs.get('image'),
+                                          kwargs.get('size'),
+                                          kwargs.get('name'),
+                                          auth=kwargs.get('auth', None))
+            if node is not None:
+                return node
+
+        return self._create_node(**kwargs)
+
+    def _create_node(self, **kwargs):
         name = kwargs.get('name')
         size = kwargs.get('size')
         image = kwargs.get('image')
-        location = kwargs.get('location', self.default_location)
+        location = kwargs.get('location') or self.default_location
         auth = kwargs.get('auth', None)
+        defer_network = kwargs.get('defer_network', self.defer_network)
 
         runner = self._create_runner(name, size, image,
                                      location=location, auth=auth)
 
-        ids = runner.runInstance()
+        policy = self._get_policy(location)
+
+        try:
+            ids = policy.call_once(runner.runInstance)
+        finally:
+            # the machine (if any) is not in the snapshot yet
+            if self.inventory is not None:
+                self.inventory.invalidate(location.id)
         node_id = ids[0]
 
         extra = {'location': location}
 
+        network_future = None
+        if defer_network:
+            network_future = self._pool.submit(policy.call,
+                                               runner.getNetworkDetail,
+                                               node_id)
+
         node = StratusLabNode(node_id=node_id,
                               name=name,
                               state=NodeState.PENDING,
@@ -465,17 +1004,74 @@ class StratusLabNodeDriver(NodeDriver):
                               driver=self,
                               size=size,
                               image=image,
-                              extra=extra)
+                              extra=extra,
+                              network_future=network_future)
 
-        try:
-            _, ip = runner.getNetworkDetail(node_id)
-            node.public_ips = [ip]
+        if network_future is None:
+            try:
+                _, ip = policy.call(runner.getNetworkDetail, node_id)
+                node.public_ips = [ip]
 
-        except Exception as e:
-            print e
+            except Exception as e:
+                log.warning('cannot recover network details of node %s: %s',
+                            node_id, e)
 
         return node
 
+    def enable_warm_pool(self, targets, auth=None, ttl=3600,
+                         refill_interval=30, boot_timeout=900):
+        """
+        Starts a warm pool of running spare nodes used by create_node.
+        The targets are (location, image, size, count) tuples giving
+        the number of spares to keep for each combination.  Spares
+        are booted with the given authentication, recycled when idle
+        for more than ttl seconds, and given up on if not running
+        after boot_timeout seconds.  Returns the WarmPool, whose
+        stats() method reports the hit rate and the boot time saved.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+
+        self.disable_warm_pool()
+
+        pool = WarmPool(self, targets, auth=auth, ttl=ttl,
+                        refill_interval=refill_interval,
+                        boot_timeout=boot_timeout)
+        pool.start()
+        self.warm_pool = pool
+        return pool
+
+    def disable_warm_pool(self, destroy_spares=True):
+        """
+        Stops the warm pool, if any, destroying its spare nodes unless
+        destroy_spares is False.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+
+        pool, self.warm_pool = self.warm_pool, None
+        if pool is not None:
+            pool.stop(destroy_spares=destroy_spares)
+
+    def close(self, destroy_spares=True):
+        """
+        Stops the background threads of the driver: the inventory
+        poller and the warm pool, whose spare nodes are destroyed
+        unless destroy_spares is False.  The driver can still be used
+        for direct calls afterwards.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+
+        poller, self.inventory_poller = self.inventory_poller, None
+        if poller is not None:
+            poller.stop()
+
+        self.disable_warm_pool(destroy_spares=destroy_spares)
+
     def _create_runner(self, name, size, image, location=None, auth=None):
 
         location = location or self.default_location
@@ -492,8 +1088,8 @@ class StratusLabNodeDriver(NodeDriver):
 
         pubkey_file = None
         if isinstance(auth, NodeAuthSSHKey):
-            _, pubkey_file = tempfile.mkstemp(suffix='_pub.key', prefix='ssh_')
-            with open(pubkey_file, 'w') as f:
+            fd, pubkey_file = tempfile.mkstemp(suffix='_pub.key', prefix='ssh_')
+            with os.fdopen(fd, 'w') as f:
                 f.write(auth.pubkey)
 
             holder.set('userPublicKeyFile', pubkey_file)
@@ -510,10 +1106,12 @@ class StratusLabNodeDriver(NodeDriver):
         holder.set('vmRam', size.ram)
         holder.set('vmSwap', size.disk)
 
-        runner = VmManagerFactory.create(image.id, holder)
-
-        if pubkey_file:
-            os.remove(pubkey_file)
+        try:
+            runner = self.backend.create_vm_manager(location.id, image.id,
+                                                    holder)
+        finally:
+            if pubkey_file:
+                os.remove(pubkey_file)
 
         return runner
 
@@ -543,7 +1141,13 @@ class StratusLabNodeDriver(NodeDriver):
 
         runner = self._create_runner(node.name, node.size, node.image,
                                      location=node.location)
-        runner.killInstances([node.id])
+        try:
+            self._get_policy(node.location).call_once(runner.killInstances,
+                                                      [node.id])
+        finally:
+            if self.inventory is not None:
+                self.inventory.invalidate(
+                    (node.location or self.default_location).id)
 
         node.state = NodeState.TERMINATED
 
@@ -556,45 +1160,155 @@ class StratusLabNodeDriver(NodeDriver):
         the Marketplace and the name corresponds to the title (or
         description if title isn't present).
 
-        The location parameter is ignored at the moment and the global
+        The Marketplace configured for the given location (or the
+        default location) is consulted; without one, the global
         Marketplace (https://marketplace.stratuslab.eu/metadata) is
-        consulted.
+        used.  See list_images_federated() to search the Marketplaces
+        of all locations.
 
         @inherits: L{NodeDriver.list_images}
         """
 
         location = location or self.default_location
 
-        holder = self._get_config_section(location)
-        url = holder.config.get('marketplaceEndpoint',
-                                self.DEFAULT_MARKETPLACE_URL)
-        endpoint = '%s/metadata' % url
-        return self._get_marketplace_images(endpoint)
+        endpoint = '%s/metadata' % self._marketplace_url(location)
+        return self._get_marketplace_images(endpoint, location)
+
+    def list_images_federated(self, locations=None):
+        """
+        Returns the images of the Marketplaces of the given locations
+        (all locations by default).  Each distinct Marketplace is
+        downloaded once, all of them concurrently, and the results are
+        merged by image id.  The extra dictionary of each image holds
+        the ids of the locations whose Marketplace lists the image
+        ('locations') and the corresponding Marketplace endpoints
+        ('endpoints').  Marketplaces that cannot be read are logged
+        and skipped.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+
+        if locations is None:
+            locations = sorted(self.list_locations(),
+                               key=lambda location: location.id)
+
+        urls = []
+        url_locations = {}
+        for location in locations:
+            url = self._marketplace_url(location)
+            if url not in url_locations:
+                urls.append(url)
+                url_locations[url] = []
+            url_locations[url].append(location)
+
+        futures = []
+        for url in urls:
+            futures.append(self._pool.submit(self._get_marketplace_images,
+                                             '%s/metadata' % url,
+                                             url_locations[url][0]))
 
-    def _get_marketplace_images(self, url):
         images = []
+        merged = {}
+        for url, future in zip(urls, futures):
+            location_ids = [location.id for location in url_locations[url]]
+            for image in future.result():
+                federated = merged.get(image.id)
+                if federated is None:
+                    federated = NodeImage(id=image.id, name=image.name,
+                                          driver=self,
+                                          extra={'locations': [],
+                                                 'endpoints': []})
+                    merged[image.id] = federated
+                    images.append(federated)
+                # a Marketplace may list several entries for an image
+                if url not in federated.extra['endpoints']:
+                    federated.extra['endpoints'].append(url)
+                    federated.extra['locations'].extend(location_ids)
+
+        return images
+
+    def _marketplace_url(self, location):
+        holder = self._get_config_section(location)
+        url = holder.config.get('marketplaceEndpoint') or \
+            self.DEFAULT_MARKETPLACE_URL
+        return url.rstrip('/')
+
+    def _get_marketplace_images(self, url, location=None):
+        # Marketplace queries do not depend on the location, only on
+        # the endpoint; the location only selects the resilience
+        # policy.  Callers get their own copy of the shared list.
+        key = ('marketplace', None, (url,))
+        policy = self._get_policy(location)
         try:
-            filename, _ = urllib.urlretrieve(url)
-            tree = ET.parse(filename)
-            root = tree.getroot()
-            for md in root.findall(self.RDF_RDF):
-                rdf_desc = md.find(self.RDF_DESCRIPTION)
-                image_id = rdf_desc.find(self.DC_IDENTIFIER).text
-                elem = rdf_desc.find(self.DC_TITLE)
-                if elem is None or len(elem) == 0:
-                    elem = rdf_desc.find(self.DC_DESCRIPTION)
-
-                if elem is not None and elem.text is not None:
-                    name = elem.text.lstrip()[:30]
-                else:
-                    name = ''
-                images.append(NodeImage(id=image_id, name=name, driver=self))
+            images = self._single_flight.do(key, policy.call,
+                                            self._fetch_marketplace_images,
+                                            url, location)
         except Exception as e:
-            # TODO: log errors instead of ignoring them
-            print e
+            log.warning('cannot read Marketplace metadata from %s: %s',
+                        url, e)
+            images = []
+
+        return list(images)
+
+    def _fetch_marketplace_images(self, url, location=None):
+        images = []
+
+        location = location or self.default_location
+        f = self.backend.open_url(location.id, url)
+        try:
+            tree = ET.parse(f)
+        finally:
+            f.close()
+        root = tree.getroot()
+        for md in root.findall(self.RDF_RDF):
+            rdf_desc = md.find(self.RDF_DESCRIPTION)
+            image_id = rdf_desc.find(self.DC_IDENTIFIER).text
+            elem = rdf_desc.find(self.DC_TITLE)
+            if elem is None or len(elem) == 0:
+                elem = rdf_desc.find(self.DC_DESCRIPTION)
+
+            if elem is not None and elem.text is not None:
+                name = elem.text.lstrip()[:30]
+            else:
+                name = ''
+            images.append(NodeImage(id=image_id, name=name, driver=self))
 
         return images
 
+    def save_marketplace_snapshot(self, path, location=None):
+        """
+        Reads the Marketplace catalog used by list_images() for the
+        given location and saves it as a compact snapshot file.  The
+        file is replaced atomically.  Returns the number of images
+        written.  Unlike list_images(), errors reading the Marketplace
+        are raised, and the existing file is then left untouched.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+
+        location = location or self.default_location
+        url = '%s/metadata' % self._marketplace_url(location)
+        images = self._get_policy(location).call(self._fetch_marketplace_images,
+                                                 url, location)
+        write_snapshot(path, images)
+        return len(images)
+
+    def open_marketplace_snapshot(self, path):
+        """
+        Opens a snapshot written by save_marketplace_snapshot().  The
+        returned MarketplaceSnapshot is memory-mapped and supports
+        lookups by image id (get(), 'in', and indexing) and lazy
+        iteration; NodeImage objects are only created for the entries
+        that are used.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+
+        return MarketplaceSnapshot(path, driver=self)
+
     def list_sizes(self, location=None):
         """
         StratusLab node sizes are defined by the client and do not
@@ -628,16 +1342,22 @@ class StratusLabNodeDriver(NodeDriver):
         This will include private disks of the user as well as public
         disks from other users.
 
+        When an inventory store is configured, the volumes come from
+        the store if it is fresh enough.
+
         This method is not a standard part of the Libcloud node driver
         interface.
         """
 
-        config_holder = self._get_config_section(location)
+        volumes = None
+        if self.inventory is not None:
+            location_id = (location or self.default_location).id
+            volumes = self.inventory.get_volumes(location_id)
 
-        pdisk = VolumeManagerFactory.create(config_holder)
-
-        filters = {}
-        volumes = pdisk.describeVolumes(filters)
+        if volumes is None:
+            listed, volumes = self._describe_volumes_stamped(location)
+            if self.inventory is not None:
+                self.inventory.put_volumes(location_id, volumes, listed)
 
         storage_volumes = []
         for info in volumes:
@@ -645,6 +1365,19 @@ class StratusLabNodeDriver(NodeDriver):
 
         return storage_volumes
 
+    def _describe_volumes_live(self, location):
+        return self._describe_volumes_stamped(location)[1]
+
+    def _describe_volumes_stamped(self, location):
+        # (start time, volumes), as for _list_vm_infos_stamped
+        return self._coalesced_call('describeVolumes', location,
+                                    self._describe_volumes)
+
+    def _describe_volumes(self, location):
+        filters = {}
+        started = time.time()
+        return started, self._get_pdisk(location).describeVolumes(filters)
+
     def _create_storage_volume(self, info, location):
         disk_uuid = info['uuid']
         name = info['tag']
@@ -667,12 +1400,14 @@ class StratusLabNodeDriver(NodeDriver):
 
         @inherits: L{NodeDriver.create_volume}
         """
-        config_holder = self._get_config_section(location)
-
-        pdisk = VolumeManagerFactory.create(config_holder)
-
         # Creates a private disk.  Boolean flag = False means private.
-        vol_uuid = pdisk.createVolume(size, name, False)
+        try:
+            vol_uuid = self._call_once(location, self._pdisk_call,
+                                       'createVolume', size, name, False)
+        finally:
+            if self.inventory is not None:
+                self.inventory.invalidate(
+                    (location or self.default_location).id, VOLUMES)
 
         extra = {'location': location}
 
@@ -687,25 +1422,97 @@ class StratusLabNodeDriver(NodeDriver):
 
         location = self._volume_location(volume)
 
-        config_holder = self._get_config_section(location)
-        pdisk = VolumeManagerFactory.create(config_holder)
-
-        pdisk.deleteVolume(volume.id)
+        try:
+            self._call_once(location, self._pdisk_call, 'deleteVolume',
+                            volume.id)
+        finally:
+            if self.inventory is not None:
+                self.inventory.invalidate(
+                    (location or self.default_location).id, VOLUMES)
 
         return True
 
+    def create_volumes(self, specs, location=None, max_workers=8):
+        """
+        Creates several private storage volumes in parallel.  Each
+        spec is a (size, name) or (size, name, location) tuple; the
+        given location (or the default location) is used when a spec
+        does not name one.  At most max_workers calls are made at the
+        same time.  Work is grouped by location so that each worker
+        thread reuses its pdisk client for the location.
+
+        Returns a list with one (StorageVolume, exception) tuple per
+        spec, in the same order as the specs; exactly one of the two
+        elements is None.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+
+        location = location or self.default_location
+
+        requests = []
+        for spec in specs:
+            if len(spec) > 2 and spec[2] is not None:
+                requests.append((spec[0], spec[1], spec[2]))
+            else:
+                requests.append((spec[0], spec[1], location))
+
+        def create(request):
+            size, name, volume_location = request
+            return self.create_volume(size, name, location=volume_location)
+
+        return self._run_grouped(create, requests,
+                                 lambda request: request[2], max_workers)
+
+    def destroy_volumes(self, volumes, max_workers=8):
+        """
+        Destroys several storage volumes in parallel, with at most
+        max_workers calls at the same time.  Work is grouped by the
+        location of the volumes (see _volume_location).
+
+        Returns a list with one (True, exception) tuple per volume, in
+        the same order as the volumes; the first element is None when
+        the volume could not be destroyed.
+
+        This method is not a standard part of the Libcloud node driver
+        interface.
+        """
+
+        return self._run_grouped(self.destroy_volume, list(volumes),
+                                 self._volume_location, max_workers)
+
+    def _run_grouped(self, fn, items, get_location, max_workers):
+        """
+        Calls fn(item) for all items on the driver's thread pool, with
+        the worker threads grouped by location (see map_grouped), and
+        returns the (result, exception) pairs in the order of the
+        items.  Calls changing the cloud run in the worker thread
+        itself unless a mutation deadline is set, so the thread's
+        clients for the location are reused.
+
+        """
+
+        def location_id(item):
+            try:
+                item_location = get_location(item)
+            except Exception:
+                # reported by fn for this item only
+                return None
+            return (item_location or self.default_location).id
+
+        return map_grouped(self._pool, fn, items, location_id, max_workers)
+
     def attach_volume(self, node, volume, device=None):
         location = self._volume_location(volume)
 
-        config_holder = self._get_config_section(location)
-        pdisk = VolumeManagerFactory.create(config_holder)
-
         try:
             host = node.host
         except AttributeError:
             raise Exception('node does not contain host information')
 
-        pdisk.hotAttach(host, node.id, volume.id)
+        self._call_once(location, self._pdisk_call,
+                        'hotAttach', host, node.id, volume.id)
 
         try:
             volume.extra['node'] = node
@@ -718,15 +1525,13 @@ class StratusLabNodeDriver(NodeDriver):
 
         location = self._volume_location(volume)
 
-        config_holder = self._get_config_section(location)
-        pdisk = VolumeManagerFactory.create(config_holder)
-
         try:
             node = volume.extra['node']
         except (AttributeError, KeyError):
             raise Exception('volume is not attached to a node')
 
-        pdisk.hotDetach(node.id, volume.id)
+        self._call_once(location, self._pdisk_call,
+                        'hotDetach', node.id, volume.id)
 
         del (volume.extra['node'])
 
@@ -0,0 +1,217 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Process-wide cache of StratusLab driver instances.
+
+ Creating a StratusLabNodeDriver parses the user configuration file
+ and builds all of the locations and sizes.  Applications that need a
+ driver per request or per tenant can instead ask this module for a
+ shared, ready-to-use instance:
+
+ from stratuslab.libcloud.driver_cache import get_driver_instance
+ driver = get_driver_instance('/path/to/tenant.cfg')
+
+ Drivers are keyed by the configuration file path, its modification
+ time and size, the default location, the 'secure' flag, and any
+ other driver keywords.  A modified configuration file yields a new
+ driver; the least recently used drivers are evicted when the cache
+ is full.  Replaced and evicted drivers are closed, which stops their
+ background threads.  Drivers are safe to share between threads.
+
+"""
+
+import os
+import threading
+
+import stratuslab.Util as StratusLabUtil
+
+from stratuslab.libcloud.compute_driver import StratusLabNodeDriver
+from stratuslab.libcloud.singleflight import SingleFlight
+
+
+class SizeRegistry(object):
+    """
+    Shares the parsed instance type table (name to cpu, ram, and swap)
+    between drivers whose configurations define the same instance
+    types.  Only this driver-independent data is shared; each driver
+    creates its own node sizes from it.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._tables = {}
+
+    def get_instance_types(self, instance_types, build):
+        """
+        Returns the complete instance type table for the given
+        user-defined instance types (a dict), calling build() to
+        create it if necessary.  The returned dict must not be
+        modified.
+
+        """
+
+        key = tuple(sorted(instance_types.items()))
+        with self._lock:
+            table = self._tables.get(key)
+        if table is None:
+            table = build()
+            with self._lock:
+                table = self._tables.setdefault(key, table)
+        return table
+
+    def clear(self):
+        with self._lock:
+            self._tables.clear()
+
+
+class DriverCache(object):
+    """
+    LRU cache of StratusLabNodeDriver instances holding at most
+    max_size drivers.  Concurrent requests for the same missing
+    driver create it only once.
+
+    When share_sizes is True, drivers created by the cache share
+    their instance type tables through a SizeRegistry.
+
+    """
+
+    def __init__(self, max_size=64, share_sizes=True):
+        self.max_size = max_size
+        self.size_registry = SizeRegistry() if share_sizes else None
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._clock = 0
+        self._single_flight = SingleFlight()
+
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+
+    def get(self, user_config=None, default_location=None, secure=False,
+            **kwargs):
+        """
+        Returns a driver for the given configuration file, creating
+        it if there is no cached driver for the current version of
+        the file.  Other keywords are passed to the driver and must be
+        hashable.  A file-like user_config cannot be cached; a new
+        driver is returned in that case.
+
+        """
+
+        user_config = user_config or StratusLabUtil.defaultConfigFileUser
+
+        if not isinstance(user_config, basestring):
+            return self._create(user_config, default_location, secure, kwargs)
+
+        path = os.path.abspath(user_config)
+        info = os.stat(path)
+        stamp = (info.st_mtime, info.st_size)
+        key = (path, default_location, secure, tuple(sorted(kwargs.items())))
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == stamp:
+                self._hits += 1
+                self._clock += 1
+                entry[2] = self._clock
+                return entry[1]
+
+        driver = self._single_flight.do((key, stamp), self._create_entry,
+                                        key, stamp, path, default_location,
+                                        secure, kwargs)
+        return driver
+
+    def _create_entry(self, key, stamp, path, default_location, secure,
+                      kwargs):
+        driver = self._create(path, default_location, secure, kwargs)
+
+        with self._lock:
+            self._misses += 1
+            self._clock += 1
+            # replaces any driver created from an older version of the file
+            previous = self._entries.get(key)
+            self._entries[key] = [stamp, driver, self._clock]
+            closing = self._evict()
+            if previous is not None and previous[1] is not driver:
+                closing.append(previous[1])
+
+        for old_driver in closing:
+            old_driver.close()
+
+        return driver
+
+    def _create(self, user_config, default_location, secure, kwargs):
+        kwargs = dict(kwargs)
+        if self.size_registry is not None:
+            kwargs.setdefault('stratuslab_size_registry', self.size_registry)
+
+        return StratusLabNodeDriver('unused-key',
+                                    secure=secure,
+                                    stratuslab_user_config=user_config,
+                                    stratuslab_default_location=default_location,
+                                    **kwargs)
+
+    def _evict(self):
+        """Removes the least recently used drivers and returns them."""
+        evicted = []
+        while len(self._entries) > self.max_size:
+            oldest = min(self._entries.items(), key=lambda item: item[1][2])[0]
+            evicted.append(self._entries.pop(oldest)[1])
+            self._evictions += 1
+        return evicted
+
+    def clear(self):
+        with self._lock:
+            drivers = [entry[1] for entry in self._entries.values()]
+            self._entries.clear()
+        for driver in drivers:
+            driver.close()
+        if self.size_registry is not None:
+            self.size_registry.clear()
+
+    def stats(self):
+        """
+        Returns a dictionary with the number of cached drivers
+        ('size'), cache hits, misses, and evictions.
+
+        """
+
+        with self._lock:
+            return {'size': len(self._entries),
+                    'hits': self._hits,
+                    'misses': self._misses,
+                    'evictions': self._evictions}
+
+
+_default_cache = DriverCache()
+
+
+def get_driver_instance(user_config=None, default_location=None,
+                        secure=False, **kwargs):
+    """
+    Returns a shared driver from the process-wide cache.  See
+    DriverCache.get() for the parameters.
+
+    """
+
+    return _default_cache.get(user_config, default_location, secure,
+                              **kwargs)
+
+
+def get_default_cache():
+    return _default_cache
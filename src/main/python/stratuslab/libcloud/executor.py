@@ -0,0 +1,334 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Minimal futures and thread pool used by the StratusLab driver.
+
+ The standard concurrent.futures module is not available for the
+ Python versions supported by this package, so the driver uses the
+ small implementation here.  Worker threads are long-lived so that
+ the per-thread backend clients of the driver are reused.
+
+"""
+
+import atexit
+import logging
+import sys
+import threading
+import time
+import weakref
+import Queue
+
+log = logging.getLogger(__name__)
+
+# pools to shut down at exit (values unused)
+_pools = weakref.WeakKeyDictionary()
+
+
+def _shutdown_pools():
+    for pool in list(_pools.keys()):
+        pool.shutdown()
+
+atexit.register(_shutdown_pools)
+
+
+class TimeoutError(Exception):
+    """Raised when a future does not complete in the allotted time."""
+    pass
+
+
+class Future(object):
+    """
+    Result of an asynchronous call.  The result (or exception) is
+    set exactly once; callers may wait for it with a timeout.
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = threading.Event()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done.isSet()
+
+    def set_result(self, result):
+        self._set(result, None)
+
+    def set_exception(self, exc_info):
+        """Stores the exception; exc_info is a sys.exc_info() tuple."""
+        self._set(None, exc_info)
+
+    def _set(self, result, exc_info):
+        with self._lock:
+            if self._done.isSet():
+                raise RuntimeError('future already completed')
+            self._result = result
+            self._exc_info = exc_info
+            self._done.set()
+            callbacks = self._callbacks
+            self._callbacks = []
+
+        for callback in callbacks:
+            self._invoke(callback)
+
+    def add_done_callback(self, fn):
+        """
+        Calls fn(future) when the future completes, immediately if
+        it has already completed.
+
+        """
+
+        with self._lock:
+            if not self._done.isSet():
+                self._callbacks.append(fn)
+                return
+        self._invoke(fn)
+
+    def _invoke(self, callback):
+        try:
+            callback(self)
+        except Exception:
+            log.exception('future callback failed')
+
+    def wait(self, timeout=None):
+        self._done.wait(timeout)
+        return self._done.isSet()
+
+    def exception(self, timeout=None):
+        if not self.wait(timeout):
+            raise TimeoutError('future did not complete within %s s' % timeout)
+        if self._exc_info is None:
+            return None
+        return self._exc_info[1]
+
+    def result(self, timeout=None):
+        if not self.wait(timeout):
+            raise TimeoutError('future did not complete within %s s' % timeout)
+        if self._exc_info is not None:
+            raise self._exc_info[0], self._exc_info[1], self._exc_info[2]
+        return self._result
+
+
+class ThreadPool(object):
+    """
+    Elastic pool of daemon worker threads.  A new worker is started
+    whenever a task is submitted and no worker is idle, up to
+    max_workers (unlimited if None).  Workers that stay idle for
+    idle_timeout seconds exit.
+
+    A worker blocked on a hung backend call does not prevent other
+    tasks from running, because another worker is started for them.
+
+    Pools are shut down at interpreter exit, so that idle workers do
+    not wake up while the interpreter is being torn down.
+
+    """
+
+    def __init__(self, max_workers=None, idle_timeout=60, name='stratuslab'):
+        self._max_workers = max_workers
+        self._idle_timeout = idle_timeout
+        self._name = name
+
+        self._tasks = Queue.Queue()
+        self._lock = threading.Lock()
+        self._workers = 0
+        self._idle = 0
+        self._backlog = 0
+        self._threads = set()
+        self._shutdown = False
+
+        _pools[self] = True
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Schedules fn(*args, **kwargs) and returns a Future for the
+        result.
+
+        """
+
+        future = Future()
+
+        # Every queued task is reserved for exactly one worker: an
+        # idle one, a new one, or the next one to finish (backlog).
+        with self._lock:
+            if self._shutdown:
+                raise RuntimeError('thread pool %s is shut down' % self._name)
+            if self._idle > 0:
+                self._idle -= 1
+            elif self._max_workers is None or self._workers < self._max_workers:
+                self._start_worker()
+            else:
+                self._backlog += 1
+
+        self._tasks.put((future, fn, args, kwargs))
+        return future
+
+    def map(self, fn, items):
+        """
+        Calls fn(item) for every item and returns the list of futures,
+        in the same order as the items.
+
+        """
+
+        return [self.submit(fn, item) for item in items]
+
+    def shutdown(self, timeout=1.0):
+        """
+        Stops the workers once the queued tasks are done, waiting at
+        most timeout seconds for them.  No tasks may be submitted
+        afterwards.
+
+        """
+
+        with self._lock:
+            if self._shutdown:
+                return
+            self._shutdown = True
+            threads = list(self._threads)
+
+        for _ in threads:
+            self._tasks.put(None)
+
+        deadline = time.time() + timeout
+        for thread in threads:
+            thread.join(max(0, deadline - time.time()))
+
+    def _start_worker(self):
+        self._workers += 1
+        worker = threading.Thread(target=self._work,
+                                  name='%s-worker-%d' % (self._name, self._workers))
+        worker.setDaemon(True)
+        self._threads.add(worker)
+        worker.start()
+
+    def _exit_worker(self):
+        self._workers -= 1
+        self._threads.discard(threading.currentThread())
+
+    def _work(self):
+        while True:
+            try:
+                task = self._tasks.get(True, self._idle_timeout)
+            except Queue.Empty:
+                with self._lock:
+                    if self._idle > 0:
+                        self._idle -= 1
+                        self._exit_worker()
+                        return
+                continue
+
+            if task is None:
+                # shutdown
+                with self._lock:
+                    self._exit_worker()
+                return
+
+            future, fn, args, kwargs = task
+
+            try:
+                result = fn(*args, **kwargs)
+            except:
+                future.set_exception(sys.exc_info())
+            else:
+                future.set_result(result)
+
+            # do not keep the task (and what it refers to) alive while
+            # waiting for the next one
+            task = future = fn = args = kwargs = result = None
+
+            with self._lock:
+                if self._backlog > 0:
+                    self._backlog -= 1
+                else:
+                    self._idle += 1
+
+
+def wait_all(futures):
+    """
+    Waits for all of the futures and returns a list of (result,
+    exception) pairs in the same order.  Exactly one element of each
+    pair is None unless the call itself returned None.
+
+    """
+
+    results = []
+    for future in futures:
+        error = future.exception()
+        if error is None:
+            results.append((future.result(), None))
+        else:
+            results.append((None, error))
+    return results
+
+
+def map_grouped(pool, fn, items, key, max_workers):
+    """
+    Calls fn(item) for every item using at most max_workers tasks of
+    the pool at a time, and returns a list of (result, exception)
+    pairs in the same order as the items.  Items with the same
+    key(item) are kept on the same tasks as far as possible.  Each
+    task (lane) is given a home group, the groups with the most items
+    getting the most lanes, and works through it before helping with
+    the group that has the most items left.  fn runs in the lane's
+    thread, so per-thread state (such as backend clients) is reused
+    within a group.
+
+    """
+
+    items = list(items)
+    results = [None] * len(items)
+
+    groups = {}
+    order = []
+    for position, item in enumerate(items):
+        group = key(item)
+        if group not in groups:
+            groups[group] = []
+            order.append(group)
+        groups[group].append(position)
+
+    lock = threading.Lock()
+
+    def take(group):
+        with lock:
+            if not groups.get(group):
+                if not groups:
+                    return None, None
+                group = max(groups, key=lambda g: len(groups[g]))
+            positions = groups[group]
+            position = positions.pop(0)
+            if not positions:
+                del groups[group]
+            return group, position
+
+    def lane(group):
+        while True:
+            group, position = take(group)
+            if position is None:
+                return
+            try:
+                results[position] = (fn(items[position]), None)
+            except Exception as e:
+                results[position] = (None, e)
+
+    lanes = max(1, min(max_workers, len(items)))
+    order.sort(key=lambda g: -len(groups[g]))
+    homes = [order[i % len(order)] if order else None for i in xrange(lanes)]
+    wait_all([pool.submit(lane, home) for home in homes])
+
+    return results
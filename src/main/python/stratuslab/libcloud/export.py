@@ -0,0 +1,277 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Streaming export of the StratusLab inventory (nodes and volumes).
+
+ Records are written one at a time, as JSON Lines or CSV, optionally
+ gzip-compressed.  Locations are fetched in parallel, but at most one
+ location listing per fetcher thread (plus one waiting to be written)
+ is held in memory, whatever the size of the fleet.
+
+ python -m stratuslab.libcloud.export --config ~/.stratuslab/stratuslab-user.cfg \\
+     --format jsonl --gzip --output inventory.jsonl.gz
+
+"""
+
+import csv
+import gzip
+import json
+import logging
+import sys
+import threading
+import Queue
+from optparse import OptionParser
+
+from libcloud.compute.types import NodeState
+
+from stratuslab.libcloud.driver_cache import get_driver_instance
+
+log = logging.getLogger(__name__)
+
+NODE = 'node'
+VOLUME = 'volume'
+
+CSV_COLUMNS = ['type', 'id', 'name', 'state', 'public_ips', 'size',
+               'cpu', 'ram', 'disk', 'image', 'location', 'host',
+               'volume_size']
+
+_STATE_NAMES = dict((getattr(NodeState, name), name.lower())
+                    for name in dir(NodeState) if name.isupper())
+
+_DONE = object()
+
+
+def _int_or_value(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return value
+
+
+def node_record(driver, vm_info, location):
+    """Converts the raw information of a machine into a record."""
+
+    attrs = vm_info.getAttributes()
+    node = driver._vm_info_to_node(vm_info, location)
+
+    return {'type': NODE,
+            'id': node.id,
+            'name': node.name,
+            'state': _STATE_NAMES.get(node.cached_state, 'unknown'),
+            'public_ips': node.public_ips,
+            'size': node.size.id,
+            'cpu': _int_or_value(node.size.cpu),
+            'ram': _int_or_value(node.size.ram),
+            'disk': _int_or_value(node.size.disk),
+            'image': node.image.id,
+            'location': location.id,
+            'host': attrs.get('history_records_history_hostname')}
+
+
+def volume_record(volume, location):
+    """Converts a StorageVolume into a record."""
+
+    return {'type': VOLUME,
+            'id': volume.id,
+            'name': volume.name,
+            'volume_size': volume.size,
+            'location': location.id}
+
+
+class JsonLinesWriter(object):
+
+    def __init__(self, out):
+        self._out = out
+
+    def write(self, record):
+        self._out.write(json.dumps(record, sort_keys=True))
+        self._out.write('\n')
+
+
+class CsvWriter(object):
+
+    def __init__(self, out):
+        self._writer = csv.writer(out)
+        self._writer.writerow(CSV_COLUMNS)
+
+    def write(self, record):
+        row = []
+        for column in CSV_COLUMNS:
+            value = record.get(column)
+            if value is None:
+                value = ''
+            elif isinstance(value, list):
+                value = ' '.join(value)
+            elif isinstance(value, unicode):
+                value = value.encode('utf-8')
+            row.append(value)
+        self._writer.writerow(row)
+
+
+WRITERS = {'jsonl': JsonLinesWriter, 'csv': CsvWriter}
+
+
+def _fetch(driver, location, nodes, volumes):
+    """Returns the records of one location as a list."""
+
+    records = []
+    if nodes:
+        for vm_info in driver.list_vm_infos(location):
+            records.append(node_record(driver, vm_info, location))
+    if volumes:
+        for volume in driver.list_volumes(location):
+            records.append(volume_record(volume, location))
+    return records
+
+
+def export_inventory(driver, out, format='jsonl', locations=None,
+                     nodes=True, volumes=True, parallel=4):
+    """
+    Writes the inventory of the given locations (all locations of
+    the driver by default) to the file-like object out.  Up to
+    'parallel' locations are fetched at the same time.  Locations that
+    cannot be read are logged and skipped.
+
+    Returns a dictionary with the number of records written
+    ('records') and the ids of the locations that failed
+    ('failures').
+
+    """
+
+    writer = WRITERS[format](out)
+
+    if locations is None:
+        locations = driver.list_locations()
+    pending = Queue.Queue()
+    for location in locations:
+        pending.put(location)
+
+    # Each fetcher holds at most one location listing while it waits
+    # for room in the queue, which bounds the memory used.
+    batches = Queue.Queue(maxsize=1)
+
+    def fetcher():
+        while True:
+            try:
+                location = pending.get_nowait()
+            except Queue.Empty:
+                batches.put(_DONE)
+                return
+            try:
+                batches.put((location, _fetch(driver, location, nodes, volumes)))
+            except Exception as e:
+                batches.put((location, e))
+
+    threads = max(1, min(parallel, len(locations)))
+    for _ in xrange(threads):
+        thread = threading.Thread(target=fetcher, name='stratuslab-export')
+        thread.setDaemon(True)
+        thread.start()
+
+    count = 0
+    failures = []
+    finished = 0
+    while finished < threads:
+        batch = batches.get()
+        if batch is _DONE:
+            finished += 1
+            continue
+
+        location, records = batch
+        if isinstance(records, Exception):
+            log.warning('cannot export location %s: %s', location.id, records)
+            failures.append(location.id)
+            continue
+
+        for record in records:
+            writer.write(record)
+            count += 1
+        del records, batch
+
+    return {'records': count, 'failures': failures}
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]',
+                          description='Streams the StratusLab inventory '
+                                      '(nodes and volumes) of all locations '
+                                      'as JSON Lines or CSV.')
+    parser.add_option('--config', dest='config', default=None,
+                      help='StratusLab user configuration file')
+    parser.add_option('--location', dest='locations', action='append',
+                      default=None,
+                      help='location to export (repeatable; default all)')
+    parser.add_option('--format', dest='format', default='jsonl',
+                      choices=sorted(WRITERS.keys()),
+                      help='output format: jsonl (default) or csv')
+    parser.add_option('--output', dest='output', default='-',
+                      help='output file (default standard output)')
+    parser.add_option('--gzip', dest='gzip', action='store_true',
+                      default=False, help='gzip-compress the output')
+    parser.add_option('--parallel', dest='parallel', type='int', default=4,
+                      help='number of locations fetched at the same time')
+    parser.add_option('--no-nodes', dest='nodes', action='store_false',
+                      default=True, help='do not export nodes')
+    parser.add_option('--no-volumes', dest='volumes', action='store_false',
+                      default=True, help='do not export volumes')
+
+    options, _ = parser.parse_args(argv)
+
+    logging.basicConfig()
+
+    driver = get_driver_instance(options.config)
+
+    locations = None
+    if options.locations:
+        unknown = [location_id for location_id in options.locations
+                   if location_id not in driver.locations]
+        if unknown:
+            parser.error('unknown location(s): %s' % ', '.join(unknown))
+        locations = [driver.locations[location_id]
+                     for location_id in options.locations]
+
+    if options.output == '-':
+        out = sys.stdout
+    else:
+        out = open(options.output, 'wb')
+
+    try:
+        if options.gzip:
+            stream = gzip.GzipFile(fileobj=out, mode='wb')
+        else:
+            stream = out
+        try:
+            result = export_inventory(driver, stream,
+                                      format=options.format,
+                                      locations=locations,
+                                      nodes=options.nodes,
+                                      volumes=options.volumes,
+                                      parallel=options.parallel)
+        finally:
+            if stream is not out:
+                stream.close()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    if result['failures']:
+        sys.stderr.write('failed locations: %s\n' % ', '.join(result['failures']))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,332 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Inventory store shared by the processes of a multi-worker deployment.
+
+ The store is a local SQLite database in WAL mode holding, for each
+ location, a snapshot of the machines (as returned by listVms) and of
+ the volumes (as returned by describeVolumes), with the time of the
+ snapshot.  Drivers configured with the same store read from it as
+ long as the snapshot is fresh enough and fall back to a live call
+ otherwise.
+
+ Snapshots are stamped with the time at which their listing
+ started.  Operations that change the machines or volumes of a
+ location invalidate the corresponding snapshot: a snapshot counts
+ as fresh only if its listing started after the last invalidation,
+ and a listing that started earlier (or before the stored snapshot)
+ is not stored, so that a listing running concurrently with a
+ change does not hide it.
+
+ A single poller, elected with a file lock, refreshes the snapshots
+ of all locations periodically.  When the elected process dies, its
+ lock is released and another process takes over.  Errors of the
+ database are logged and treated as missing data, so that the
+ drivers keep working with live calls.
+
+ driver = StratusLabNodeDriver('unused-key',
+                               stratuslab_inventory_store='/var/run/sl.db',
+                               stratuslab_inventory_max_age=30)
+
+"""
+
+import cPickle as pickle
+import logging
+import sqlite3
+import threading
+import time
+from functools import wraps
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+log = logging.getLogger(__name__)
+
+VMS = 'vms'
+VOLUMES = 'volumes'
+
+_SCHEMA = [
+    'CREATE TABLE IF NOT EXISTS snapshots ('
+    ' location TEXT, kind TEXT, updated REAL,'
+    ' PRIMARY KEY (location, kind))',
+    'CREATE TABLE IF NOT EXISTS invalidations ('
+    ' location TEXT, kind TEXT, invalidated REAL,'
+    ' PRIMARY KEY (location, kind))',
+    'CREATE TABLE IF NOT EXISTS vms ('
+    ' location TEXT, id TEXT, data BLOB,'
+    ' PRIMARY KEY (location, id))',
+    'CREATE TABLE IF NOT EXISTS volumes ('
+    ' location TEXT, uuid TEXT, data BLOB,'
+    ' PRIMARY KEY (location, uuid))',
+]
+
+
+def _dumps(value):
+    return sqlite3.Binary(pickle.dumps(value, pickle.HIGHEST_PROTOCOL))
+
+
+def _loads(data):
+    return pickle.loads(str(data))
+
+
+def _logged(fn):
+    """Logs database errors and returns None instead."""
+
+    @wraps(fn)
+    def wrapper(*args, **kwargs):
+        try:
+            return fn(*args, **kwargs)
+        except sqlite3.Error as e:
+            log.warning('inventory store error in %s: %s', fn.__name__, e)
+            return None
+
+    return wrapper
+
+
+class InventoryStore(object):
+    """
+    Per-location snapshots of machines and volumes in a SQLite file.
+    Each thread uses its own connection.
+
+    """
+
+    def __init__(self, path, max_age=30):
+        self.path = path
+        self.max_age = max_age
+        self._local = threading.local()
+
+        with self._connection() as connection:
+            for statement in _SCHEMA:
+                connection.execute(statement)
+
+    def _connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _is_fresh(self, connection, location_id, kind, max_age):
+        max_age = self.max_age if max_age is None else max_age
+        row = connection.execute('SELECT s.updated, i.invalidated '
+                                 'FROM snapshots s LEFT JOIN invalidations i '
+                                 'ON i.location = s.location AND i.kind = s.kind '
+                                 'WHERE s.location = ? AND s.kind = ?',
+                                 (location_id, kind)).fetchone()
+        if row is None:
+            return False
+        updated, invalidated = row
+        if invalidated is not None and updated <= invalidated:
+            return False
+        return time.time() - updated <= max_age
+
+    @_logged
+    def age(self, location_id, kind=VMS):
+        """Returns the age in seconds of a snapshot, or None."""
+        row = self._connection().execute('SELECT updated FROM snapshots '
+                                         'WHERE location = ? AND kind = ?',
+                                         (location_id, kind)).fetchone()
+        if row is None:
+            return None
+        return time.time() - row[0]
+
+    def _put(self, table, key_column, location_id, kind, items, listed):
+        listed = time.time() if listed is None else listed
+        with self._connection() as connection:
+            # only replace the snapshot with a newer listing
+            cursor = connection.execute(
+                'INSERT OR REPLACE INTO snapshots (location, kind, updated) '
+                'SELECT ?, ?, ? WHERE NOT EXISTS ('
+                ' SELECT 1 FROM snapshots'
+                ' WHERE location = ? AND kind = ? AND updated >= ?'
+                ' UNION ALL SELECT 1 FROM invalidations'
+                ' WHERE location = ? AND kind = ? AND invalidated >= ?)',
+                (location_id, kind, listed) + (location_id, kind, listed) * 2)
+            if cursor.rowcount == 0:
+                return
+            connection.execute('DELETE FROM %s WHERE location = ?' % table,
+                               (location_id,))
+            connection.executemany('INSERT OR REPLACE INTO %s '
+                                   '(location, %s, data) VALUES (?, ?, ?)' %
+                                   (table, key_column),
+                                   [(location_id, key, _dumps(data))
+                                    for key, data in items])
+
+    def _get(self, table, location_id, kind, max_age):
+        connection = self._connection()
+        if not self._is_fresh(connection, location_id, kind, max_age):
+            return None
+        rows = connection.execute('SELECT data FROM %s WHERE location = ?' %
+                                  table, (location_id,))
+        return [_loads(row[0]) for row in rows]
+
+    @_logged
+    def put_vms(self, location_id, vm_infos, listed=None):
+        """
+        Replaces the machine snapshot of the location, unless the
+        stored snapshot or the last invalidation is more recent than
+        listed, the time at which the listing started (default now).
+
+        """
+
+        items = [(str(vm_info.getAttributes().get('id')), vm_info)
+                 for vm_info in vm_infos]
+        self._put('vms', 'id', location_id, VMS, items, listed)
+
+    @_logged
+    def get_vms(self, location_id, max_age=None):
+        """
+        Returns the machines of the location, or None if there is no
+        snapshot younger than max_age seconds (default for the store).
+
+        """
+
+        return self._get('vms', location_id, VMS, max_age)
+
+    @_logged
+    def get_vm(self, location_id, vm_id, max_age=None):
+        """
+        Returns the information of one machine from a fresh snapshot,
+        or None if the snapshot is too old or does not contain it.
+
+        """
+
+        connection = self._connection()
+        if not self._is_fresh(connection, location_id, VMS, max_age):
+            return None
+        row = connection.execute('SELECT data FROM vms '
+                                 'WHERE location = ? AND id = ?',
+                                 (location_id, str(vm_id))).fetchone()
+        if row is None:
+            return None
+        return _loads(row[0])
+
+    @_logged
+    def invalidate(self, location_id, kind=VMS):
+        """
+        Marks the snapshot of the location as stale, including any
+        snapshot from a listing that is still running.
+
+        """
+
+        with self._connection() as connection:
+            connection.execute('INSERT OR REPLACE INTO invalidations '
+                               '(location, kind, invalidated) VALUES (?, ?, ?)',
+                               (location_id, kind, time.time()))
+
+    @_logged
+    def put_volumes(self, location_id, volumes, listed=None):
+        """Replaces the volume snapshot (pdisk descriptions)."""
+        items = [(info['uuid'], info) for info in volumes]
+        self._put('volumes', 'uuid', location_id, VOLUMES, items, listed)
+
+    @_logged
+    def get_volumes(self, location_id, max_age=None):
+        """Like get_vms() for the volume descriptions."""
+        return self._get('volumes', location_id, VOLUMES, max_age)
+
+
+class InventoryPoller(object):
+    """
+    Background thread refreshing the snapshots of all of the
+    locations of a driver every interval seconds, but only while it
+    holds the poller lock (the store path with a '.lock' suffix).
+    Processes that do not hold the lock retry at every interval.
+
+    """
+
+    def __init__(self, driver, store, interval=10):
+        self.driver = driver
+        self.store = store
+        self.interval = interval
+
+        self._lock_file = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def is_leader(self):
+        return self._lock_file is not None
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='stratuslab-inventory-poller')
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        self._release()
+
+    def _acquire(self):
+        if self._lock_file is not None:
+            return True
+        if fcntl is None:
+            # no file locks on this platform: every process polls
+            self._lock_file = True
+            return True
+
+        lock_file = open(self.store.path + '.lock', 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock_file.close()
+            return False
+
+        self._lock_file = lock_file
+        log.info('elected as inventory poller for %s', self.store.path)
+        return True
+
+    def _release(self):
+        lock_file, self._lock_file = self._lock_file, None
+        if lock_file not in (None, True):
+            lock_file.close()
+
+    def _run(self):
+        while not self._stopped.isSet():
+            if self._acquire():
+                self.poll()
+            self._stopped.wait(self.interval)
+
+    def poll(self):
+        """
+        Refreshes the snapshots of all locations once, querying the
+        locations in parallel on the thread pool of the driver.
+
+        """
+
+        locations = self.driver.list_locations()
+        futures = self.driver._pool.map(self._poll_location, locations)
+        for location, future in zip(locations, futures):
+            try:
+                future.result()
+            except Exception as e:
+                log.warning('cannot refresh inventory of %s: %s',
+                            location.id, e)
+
+    def _poll_location(self, location):
+        listed, vm_infos = self.driver._list_vm_infos_stamped(location)
+        self.store.put_vms(location.id, vm_infos, listed)
+        listed, volumes = self.driver._describe_volumes_stamped(location)
+        self.store.put_volumes(location.id, volumes, listed)
@@ -0,0 +1,603 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Load generator for the StratusLab driver.
+
+ Drives a StratusLabNodeDriver with a mixed workload from many
+ threads for a given duration, against an in-memory stub of the
+ StratusLab services with configurable latency and error rate.
+ Nothing leaves the local machine: the user configuration (one
+ section per simulated location) is written to a temporary file.
+
+ python -m stratuslab.libcloud.loadgen --duration 60 --threads 32 \\
+     --locations 4 --latency 0.02 --error-rate 0.01 \\
+     --mix list_nodes=1,state=10,create_destroy=2,attach_detach=2
+
+ The report gives, for each operation, the throughput and the 50th,
+ 95th, and 99th percentile latencies, followed by the number of
+ backend calls per API call and the peak resident memory.
+
+"""
+
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from optparse import OptionParser
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from libcloud.compute.base import NodeImage
+
+from stratuslab.libcloud.compute_driver import StratusLabNodeDriver
+
+log = logging.getLogger(__name__)
+
+DEFAULT_MIX = 'list_nodes=1,state=10,create_destroy=2,attach_detach=2'
+
+
+class StubBackendError(Exception):
+    """Error injected by the StubBackend."""
+    pass
+
+
+class StubVmInfo(object):
+    """Stands in for the CloudInfo objects returned by the Monitor."""
+
+    def __init__(self, attribs):
+        self.attribs = attribs
+
+    def getAttributes(self):
+        return self.attribs
+
+
+class _StubLocation(object):
+
+    def __init__(self, location_id):
+        self.location_id = location_id
+        self.vms = {}
+        self.volumes = {}
+
+
+class _StubMonitor(object):
+
+    def __init__(self, backend, location_id):
+        self._backend = backend
+        self._location_id = location_id
+
+    def listVms(self):
+        location = self._backend._call(self._location_id, 'listVms')
+        with self._backend._lock:
+            return [StubVmInfo(dict(attrs)) for attrs in location.vms.values()]
+
+    def vmDetail(self, ids):
+        location = self._backend._call(self._location_id, 'vmDetail')
+        with self._backend._lock:
+            return [StubVmInfo(dict(location.vms[str(vm_id)]))
+                    for vm_id in ids if str(vm_id) in location.vms]
+
+
+class _StubVmManager(object):
+
+    def __init__(self, backend, location_id, image_id, config_holder):
+        self._backend = backend
+        self._location_id = location_id
+        self._image_id = image_id
+        self._name = config_holder.options.get('vmName')
+        self._cpu = config_holder.options.get('vmCpu')
+        self._ram = config_holder.options.get('vmRam')
+        self._swap = config_holder.options.get('vmSwap')
+
+    def runInstance(self):
+        location = self._backend._call(self._location_id, 'runInstance')
+        attrs = self._backend._new_vm(self._name, self._image_id, self._cpu,
+                                      self._ram, self._swap)
+        with self._backend._lock:
+            location.vms[attrs['id']] = attrs
+        return [int(attrs['id'])]
+
+    def getNetworkDetail(self, vm_id):
+        location = self._backend._call(self._location_id, 'getNetworkDetail')
+        with self._backend._lock:
+            return 'public', location.vms[str(vm_id)]['template_nic_ip']
+
+    def killInstances(self, ids):
+        location = self._backend._call(self._location_id, 'killInstances')
+        with self._backend._lock:
+            for vm_id in ids:
+                location.vms.pop(str(vm_id), None)
+
+
+class _StubVolumeManager(object):
+
+    def __init__(self, backend, location_id):
+        self._backend = backend
+        self._location_id = location_id
+
+    def describeVolumes(self, filters):
+        location = self._backend._call(self._location_id, 'describeVolumes')
+        with self._backend._lock:
+            return [dict(info) for info in location.volumes.values()]
+
+    def createVolume(self, size, tag, visibility):
+        location = self._backend._call(self._location_id, 'createVolume')
+        with self._backend._lock:
+            self._backend._volume_count += 1
+            volume_uuid = 'stub-%d' % self._backend._volume_count
+            location.volumes[volume_uuid] = {'uuid': volume_uuid, 'tag': tag,
+                                             'size': str(size)}
+        return volume_uuid
+
+    def deleteVolume(self, volume_uuid):
+        location = self._backend._call(self._location_id, 'deleteVolume')
+        with self._backend._lock:
+            location.volumes.pop(volume_uuid, None)
+        return True
+
+    def hotAttach(self, host, vm_id, volume_uuid):
+        self._backend._call(self._location_id, 'hotAttach')
+        return True
+
+    def hotDetach(self, vm_id, volume_uuid):
+        self._backend._call(self._location_id, 'hotDetach')
+        return True
+
+
+class StubBackend(object):
+    """
+    In-memory backend (see the backend module) simulating the
+    StratusLab services of any number of locations.  Every call
+    sleeps for a random time averaging latency seconds and fails
+    with StubBackendError with probability error_rate.  Each
+    location starts with vms_per_location running machines.
+
+    """
+
+    def __init__(self, latency=0.01, error_rate=0.0, vms_per_location=20,
+                 seed=None):
+        self.latency = latency
+        self.error_rate = error_rate
+        self.vms_per_location = vms_per_location
+
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._locations = {}
+        self._calls = {}
+        self._vm_count = 0
+        self._volume_count = 0
+
+    def create_monitor(self, location_id, config_holder):
+        return _StubMonitor(self, location_id)
+
+    def create_volume_manager(self, location_id, config_holder):
+        return _StubVolumeManager(self, location_id)
+
+    def create_vm_manager(self, location_id, image_id, config_holder):
+        return _StubVmManager(self, location_id, image_id, config_holder)
+
+    def open_url(self, location_id, url):
+        raise StubBackendError('no Marketplace in the stub backend')
+
+    def _new_vm(self, name, image_id, cpu, ram, swap):
+        with self._lock:
+            self._vm_count += 1
+            vm_id = self._vm_count
+        return {'id': str(vm_id),
+                'name': name or 'vm-%d' % vm_id,
+                'state_summary': 'Running',
+                'template_nic_ip': '10.%d.%d.%d' % (vm_id >> 16 & 255,
+                                                    vm_id >> 8 & 255,
+                                                    vm_id & 255),
+                'template_cpu': str(cpu),
+                'template_memory': str(ram),
+                'template_disk_size': str(swap),
+                'template_disk_source': 'https://marketplace/metadata/%s' % image_id,
+                'history_records_history_hostname': 'host-%d' % (vm_id % 16)}
+
+    def _get_location(self, location_id):
+        with self._lock:
+            location = self._locations.get(location_id)
+            if location is not None:
+                return location
+            location = _StubLocation(location_id)
+            self._locations[location_id] = location
+
+        for _ in xrange(self.vms_per_location):
+            attrs = self._new_vm(None, 'stub-image', 1, 128, 0)
+            with self._lock:
+                location.vms[attrs['id']] = attrs
+        return location
+
+    def _call(self, location_id, method):
+        location = self._get_location(location_id)
+
+        with self._lock:
+            self._calls[method] = self._calls.get(method, 0) + 1
+            delay = self._random.uniform(0, 2 * self.latency)
+            failed = self._random.random() < self.error_rate
+
+        if delay:
+            time.sleep(delay)
+        if failed:
+            raise StubBackendError('injected failure of %s at %s' %
+                                   (method, location_id))
+        return location
+
+    def vms(self, location_id):
+        """
+        Returns copies of the attributes of the machines of a location,
+        by machine id, without counting as a backend call.
+
+        """
+
+        location = self._get_location(location_id)
+        with self._lock:
+            return dict((vm_id, dict(attrs))
+                        for vm_id, attrs in location.vms.items())
+
+    def stats(self):
+        """Returns a dictionary with the number of calls per method."""
+        with self._lock:
+            return dict(self._calls)
+
+    def call_count(self):
+        with self._lock:
+            return sum(self._calls.values())
+
+
+class LatencyHistogram(object):
+    """
+    Latencies in logarithmic buckets (2% wide), so that long runs use
+    constant memory.  Failed calls are counted separately.
+
+    """
+
+    FACTOR = 1.02
+
+    def __init__(self):
+        self.buckets = {}
+        self.count = 0
+        self.errors = 0
+
+    def add(self, seconds):
+        bucket = int(math.log(max(seconds, 1e-7)) / math.log(self.FACTOR))
+        self.buckets[bucket] = self.buckets.get(bucket, 0) + 1
+        self.count += 1
+
+    def merge(self, other):
+        for bucket, count in other.buckets.items():
+            self.buckets[bucket] = self.buckets.get(bucket, 0) + count
+        self.count += other.count
+        self.errors += other.errors
+
+    def percentile(self, p):
+        """Returns the p-th percentile in seconds (None if empty)."""
+        if not self.count:
+            return None
+        rank = p / 100.0 * self.count
+        seen = 0
+        for bucket in sorted(self.buckets):
+            seen += self.buckets[bucket]
+            if seen >= rank:
+                return self.FACTOR ** (bucket + 1)
+        return self.FACTOR ** (max(self.buckets) + 1)
+
+
+def parse_mix(text):
+    """
+    Parses a workload mix such as 'list_nodes=1,state=10' into a list
+    of (operation, weight) tuples.
+
+    """
+
+    mix = []
+    for item in text.split(','):
+        name, _, weight = item.strip().partition('=')
+        if name not in OPERATIONS:
+            raise ValueError('unknown operation %r' % name)
+        mix.append((name, float(weight or 1)))
+    return mix
+
+
+class _Worker(object):
+    """State of one load thread."""
+
+    def __init__(self, driver, context, seed):
+        self.driver = driver
+        self.context = context
+        self.random = random.Random(seed)
+        self.histograms = {}
+        self.volumes = {}
+
+    def timed(self, operation, fn, *args, **kwargs):
+        histogram = self.histograms.get(operation)
+        if histogram is None:
+            histogram = self.histograms[operation] = LatencyHistogram()
+
+        start = time.time()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            histogram.errors += 1
+            log.debug('%s failed: %s', operation, e)
+            raise
+        histogram.add(time.time() - start)
+        return result
+
+    def pick_node(self):
+        return self.random.choice(self.context['nodes'])
+
+
+def _list_nodes(worker):
+    worker.timed('list_nodes', worker.driver.list_nodes)
+
+
+def _state(worker):
+    node = worker.pick_node()
+    worker.timed('state', lambda: node.state)
+
+
+def _create_destroy(worker):
+    context = worker.context
+    location = worker.random.choice(context['locations'])
+    node = worker.timed('create_node', worker.driver.create_node,
+                        name='loadgen', size=context['size'],
+                        image=context['image'], location=location)
+    worker.timed('destroy_node', worker.driver.destroy_node, node)
+
+
+def _attach_detach(worker):
+    node = worker.pick_node()
+    location = node.extra['location']
+
+    volume = worker.volumes.get(location.id)
+    if volume is None:
+        volume = worker.timed('create_volume', worker.driver.create_volume,
+                              1, 'loadgen', location)
+        worker.volumes[location.id] = volume
+
+    worker.timed('attach_volume', worker.driver.attach_volume, node, volume)
+    worker.timed('detach_volume', worker.driver.detach_volume, volume)
+
+
+OPERATIONS = {'list_nodes': _list_nodes,
+              'state': _state,
+              'create_destroy': _create_destroy,
+              'attach_detach': _attach_detach}
+
+
+def peak_rss():
+    """Returns the peak resident set size in bytes, or None."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss
+    return rss * 1024
+
+
+def run_load(driver, backend, duration=30, threads=16, mix=None, seed=None):
+    """
+    Runs the workload mix (see parse_mix) on the driver from the
+    given number of threads for duration seconds.  The backend must
+    provide call_count() and stats(), like the StubBackend.
+
+    Returns a dictionary with the elapsed time, the histograms per
+    operation, the number of API and backend calls, the backend calls
+    per method, and the peak RSS.
+
+    """
+
+    mix = mix or parse_mix(DEFAULT_MIX)
+    seeds = random.Random(seed)
+
+    nodes = driver.list_nodes()
+    if not nodes:
+        raise ValueError('the backend has no nodes to work on')
+
+    context = {'nodes': nodes,
+               'locations': driver.list_locations(),
+               'size': driver.list_sizes()[0],
+               'image': NodeImage(id='stub-image', name='stub-image',
+                                  driver=driver)}
+
+    operations = [OPERATIONS[name] for name, _ in mix]
+    weights = [weight for _, weight in mix]
+    total_weight = sum(weights)
+
+    workers = [_Worker(driver, context, seeds.random())
+               for _ in xrange(threads)]
+
+    def work(worker, deadline):
+        while time.time() < deadline:
+            point = worker.random.uniform(0, total_weight)
+            for operation, weight in zip(operations, weights):
+                point -= weight
+                if point <= 0:
+                    break
+            try:
+                operation(worker)
+            except Exception:
+                # counted as an error of the failing step
+                pass
+
+        for volume in worker.volumes.values():
+            try:
+                driver.destroy_volume(volume)
+            except Exception as e:
+                log.debug('cannot clean up volume %s: %s', volume.id, e)
+
+    backend_calls = backend.call_count()
+    backend_stats = backend.stats()
+    start = time.time()
+    deadline = start + duration
+
+    load_threads = []
+    for worker in workers:
+        thread = threading.Thread(target=work, args=(worker, deadline),
+                                  name='stratuslab-loadgen')
+        thread.setDaemon(True)
+        thread.start()
+        load_threads.append(thread)
+    for thread in load_threads:
+        thread.join()
+
+    elapsed = time.time() - start
+
+    histograms = {}
+    for worker in workers:
+        for operation, histogram in worker.histograms.items():
+            histograms.setdefault(operation, LatencyHistogram()).merge(histogram)
+
+    calls = {}
+    for method, count in backend.stats().items():
+        count -= backend_stats.get(method, 0)
+        if count:
+            calls[method] = count
+
+    return {'elapsed': elapsed,
+            'histograms': histograms,
+            'api_calls': sum(h.count + h.errors for h in histograms.values()),
+            'backend_calls': backend.call_count() - backend_calls,
+            'backend_methods': calls,
+            'peak_rss': peak_rss()}
+
+
+def format_report(results):
+    """Formats the results of run_load as a text table."""
+
+    def ms(seconds):
+        return '-' if seconds is None else '%.2f' % (seconds * 1000)
+
+    elapsed = results['elapsed']
+    lines = ['%-14s %9s %7s %9s %9s %9s %9s' %
+             ('operation', 'calls', 'errors', 'ops/s',
+              'p50 ms', 'p95 ms', 'p99 ms')]
+    for operation in sorted(results['histograms']):
+        histogram = results['histograms'][operation]
+        lines.append('%-14s %9d %7d %9.1f %9s %9s %9s' %
+                     (operation, histogram.count, histogram.errors,
+                      histogram.count / elapsed,
+                      ms(histogram.percentile(50)),
+                      ms(histogram.percentile(95)),
+                      ms(histogram.percentile(99))))
+
+    api_calls = results['api_calls']
+    backend_calls = results['backend_calls']
+    lines.append('')
+    lines.append('duration: %.1f s, API calls: %d (%.1f/s)' %
+                 (elapsed, api_calls, api_calls / elapsed))
+    lines.append('backend calls: %d (%.2f per API call)' %
+                 (backend_calls,
+                  float(backend_calls) / api_calls if api_calls else 0.0))
+    for method in sorted(results['backend_methods']):
+        lines.append('  %-18s %d' % (method, results['backend_methods'][method]))
+
+    rss = results['peak_rss']
+    if rss is not None:
+        lines.append('peak RSS: %.1f MB' % (rss / 1048576.0))
+
+    return '\n'.join(lines)
+
+
+def write_config(path, locations):
+    """Writes a user configuration with the given number of locations."""
+
+    with open(path, 'w') as f:
+        f.write('[default]\n'
+                'selected_section = loc0\n'
+                'endpoint = loc0.invalid\n'
+                'username = loadgen\n'
+                'password = loadgen\n\n')
+        for i in xrange(locations):
+            f.write('[loc%d]\nendpoint = loc%d.invalid\n\n' % (i, i))
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options]',
+                          description='Drives the StratusLab driver with a '
+                                      'mixed workload against stubbed '
+                                      'services and reports latencies, '
+                                      'backend calls, and memory use.')
+    parser.add_option('--duration', dest='duration', type='float', default=30,
+                      help='duration of the run in seconds (default 30)')
+    parser.add_option('--threads', dest='threads', type='int', default=16,
+                      help='number of load threads (default 16)')
+    parser.add_option('--locations', dest='locations', type='int', default=4,
+                      help='number of simulated locations (default 4)')
+    parser.add_option('--vms', dest='vms', type='int', default=20,
+                      help='initial machines per location (default 20)')
+    parser.add_option('--latency', dest='latency', type='float', default=0.01,
+                      help='mean backend latency in seconds (default 0.01)')
+    parser.add_option('--error-rate', dest='error_rate', type='float',
+                      default=0.0,
+                      help='fraction of failing backend calls (default 0)')
+    parser.add_option('--mix', dest='mix', default=DEFAULT_MIX,
+                      help='weighted operations (default %s)' % DEFAULT_MIX)
+    parser.add_option('--seed', dest='seed', type='int', default=None,
+                      help='seed of the random generators')
+    parser.add_option('--inventory-store', dest='inventory_store',
+                      default=None,
+                      help='use a shared inventory store in this file')
+    parser.add_option('--defer-network', dest='defer_network',
+                      action='store_true', default=False,
+                      help='defer the network lookup in create_node')
+
+    options, _ = parser.parse_args(argv)
+
+    try:
+        mix = parse_mix(options.mix)
+    except ValueError as e:
+        parser.error(str(e))
+
+    logging.basicConfig()
+
+    backend = StubBackend(latency=options.latency,
+                          error_rate=options.error_rate,
+                          vms_per_location=options.vms,
+                          seed=options.seed)
+
+    fd, config_file = tempfile.mkstemp(suffix='.cfg', prefix='loadgen_')
+    os.close(fd)
+    try:
+        write_config(config_file, options.locations)
+
+        kwargs = {'stratuslab_user_config': config_file,
+                  'stratuslab_backend': backend,
+                  'stratuslab_defer_network': options.defer_network}
+        if options.inventory_store:
+            kwargs['stratuslab_inventory_store'] = options.inventory_store
+
+        driver = StratusLabNodeDriver('unused-key', **kwargs)
+    finally:
+        os.remove(config_file)
+
+    results = run_load(driver, backend, duration=options.duration,
+                       threads=options.threads, mix=mix, seed=options.seed)
+
+    print format_report(results)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,201 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Compact, memory-mapped snapshots of the Marketplace image catalog.
+
+ A snapshot file has three parts (all integers are little-endian
+ unsigned 32-bit values):
+
+   header:  magic 'SLMPSNP1', entry count, offset of the string heap
+   table:   one record per image, sorted by image id:
+            id offset, id length, name offset, name length
+   heap:    UTF-8 encoded ids and names; offsets are heap-relative
+
+ Snapshots are opened with mmap, so that processes opening the same
+ file share its pages.  Lookups by image id are binary searches over
+ the table and NodeImage objects are only created for the entries
+ actually requested.
+
+"""
+
+import mmap
+import os
+import struct
+import tempfile
+
+from libcloud.compute.base import NodeImage
+
+MAGIC = 'SLMPSNP1'
+
+_HEADER = struct.Struct('<8sII')
+_RECORD = struct.Struct('<IIII')
+
+
+def _to_utf8(value):
+    if value is None:
+        return ''
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    return str(value)
+
+
+def write_snapshot(path, images):
+    """
+    Writes the given images to a snapshot file.  The images may be
+    NodeImage objects or (id, name) tuples.  When several images share
+    the same id, lookups return the first one given.  The file is
+    replaced atomically.
+
+    """
+
+    entries = []
+    for position, image in enumerate(images):
+        if isinstance(image, NodeImage):
+            image_id, name = image.id, image.name
+        else:
+            image_id, name = image
+        entries.append((_to_utf8(image_id), position, _to_utf8(name)))
+
+    # position keeps the sort stable for duplicate ids
+    entries.sort()
+
+    heap = []
+    records = []
+    heap_size = 0
+    for image_id, _, name in entries:
+        id_offset = heap_size
+        heap.append(image_id)
+        heap_size += len(image_id)
+
+        name_offset = heap_size
+        heap.append(name)
+        heap_size += len(name)
+
+        records.append(_RECORD.pack(id_offset, len(image_id),
+                                    name_offset, len(name)))
+
+    heap_offset = _HEADER.size + _RECORD.size * len(records)
+
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(prefix='.snapshot_', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(_HEADER.pack(MAGIC, len(records), heap_offset))
+            f.write(''.join(records))
+            f.write(''.join(heap))
+        # mkstemp creates private files; snapshots are meant to be shared
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, path)
+    except:
+        os.remove(tmp_path)
+        raise
+
+
+class MarketplaceSnapshot(object):
+    """
+    Read-only view of a snapshot file.  The NodeImage objects that
+    are returned refer to the given driver.
+
+    """
+
+    def __init__(self, path, driver=None):
+        self.path = path
+        self.driver = driver
+
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self._mmap.size() < _HEADER.size:
+            self._mmap.close()
+            raise ValueError('%s is not a Marketplace snapshot' % path)
+
+        magic, self._count, self._heap_offset = \
+            _HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            self._mmap.close()
+            raise ValueError('%s is not a Marketplace snapshot' % path)
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __len__(self):
+        return self._count
+
+    def _record(self, index):
+        return _RECORD.unpack_from(self._mmap,
+                                   _HEADER.size + index * _RECORD.size)
+
+    def _string(self, offset, length):
+        start = self._heap_offset + offset
+        return self._mmap[start:start + length]
+
+    def _id_at(self, index):
+        id_offset, id_length, _, _ = self._record(index)
+        return self._string(id_offset, id_length)
+
+    def _find(self, image_id):
+        """Returns the index of the first entry with the id, or -1."""
+        image_id = _to_utf8(image_id)
+
+        low, high = 0, self._count
+        while low < high:
+            middle = (low + high) // 2
+            if self._id_at(middle) < image_id:
+                low = middle + 1
+            else:
+                high = middle
+
+        if low < self._count and self._id_at(low) == image_id:
+            return low
+        return -1
+
+    def _image_at(self, index):
+        id_offset, id_length, name_offset, name_length = self._record(index)
+        image_id = self._string(id_offset, id_length)
+        name = self._string(name_offset, name_length).decode('utf-8')
+        return NodeImage(id=image_id, name=name, driver=self.driver)
+
+    def __contains__(self, image_id):
+        return self._find(image_id) >= 0
+
+    def __getitem__(self, image_id):
+        index = self._find(image_id)
+        if index < 0:
+            raise KeyError(image_id)
+        return self._image_at(index)
+
+    def get(self, image_id, default=None):
+        """Returns the NodeImage with the given id, or the default."""
+        index = self._find(image_id)
+        if index < 0:
+            return default
+        return self._image_at(index)
+
+    def ids(self):
+        """Iterates over the image ids, in sorted order."""
+        for index in xrange(self._count):
+            yield self._id_at(index)
+
+    def __iter__(self):
+        """Iterates over the images, creating them one at a time."""
+        for index in xrange(self._count):
+            yield self._image_at(index)
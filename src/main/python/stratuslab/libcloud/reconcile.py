@@ -0,0 +1,554 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Declarative management of StratusLab fleets.
+
+ A manifest describes the desired node groups.  Each group has a
+ name, location, image, size, count, and the volumes to attach to
+ every node of the group:
+
+ {"groups": [{"name": "web", "location": "lal",
+              "image": "BN1EEkPiBx87_uLj2-sdybSI-Xb",
+              "size": "m1.small", "count": 3,
+              "volumes": [{"name": "data", "size": 10}]}]}
+
+ The nodes of a group are named <group>-<index> and their volumes
+ are tagged <node>-<volume>.  The reconciler reads the current state
+ with one live listing of the machines and one of the volumes per
+ location, bypassing any inventory store.  It then computes the
+ minimal plan: destroy surplus nodes, nodes that are neither running
+ nor pending, and nodes with the wrong image or size, create the
+ missing nodes and volumes, and attach volumes to the new nodes.
+ The plan is run in phases.  Within a phase the steps run in
+ parallel, grouped by location, and each step is retried on failure
+ unless its outcome is unknown (a creation that timed out).
+
+ python -m stratuslab.libcloud.reconcile --dry-run fleet.json
+ python -m stratuslab.libcloud.reconcile fleet.json
+
+ Reconciling is idempotent.  A node created twice after an
+ ambiguous failure is removed by the next run.  The volumes of
+ removed nodes are kept unless pruning is requested.
+
+"""
+
+import json
+import logging
+import random
+import sys
+import time
+from optparse import OptionParser
+
+from libcloud.compute.base import NodeImage
+from libcloud.compute.types import NodeState
+
+from stratuslab.libcloud.driver_cache import get_driver_instance
+from stratuslab.libcloud.resilience import OutcomeUnknownError
+
+log = logging.getLogger(__name__)
+
+DESTROY_NODE = 'destroy-node'
+DESTROY_VOLUME = 'destroy-volume'
+CREATE_NODE = 'create-node'
+CREATE_VOLUME = 'create-volume'
+ATTACH_VOLUME = 'attach-volume'
+
+# phases of a plan, in execution order
+ACTIONS = [DESTROY_NODE, DESTROY_VOLUME, CREATE_NODE, CREATE_VOLUME,
+           ATTACH_VOLUME]
+
+# backend calls made by each step (without retries)
+BACKEND_CALLS = {DESTROY_NODE: 1,       # killInstances
+                 DESTROY_VOLUME: 1,     # deleteVolume
+                 CREATE_NODE: 2,        # runInstance, getNetworkDetail
+                 CREATE_VOLUME: 1,      # createVolume
+                 ATTACH_VOLUME: 2}      # vmDetail (host), hotAttach
+
+# listVms and describeVolumes
+LISTING_CALLS = 2
+
+# states of the nodes that are kept; nodes in other states (failed,
+# unknown) are replaced
+_LIVE_STATES = (NodeState.RUNNING, NodeState.PENDING)
+
+
+class DependencyError(Exception):
+    """Raised for steps depending on a step that failed."""
+    pass
+
+
+class NodeGroup(object):
+    """A group of identical nodes of a manifest."""
+
+    def __init__(self, name, location, image, size, count, volumes=None):
+        self.name = name
+        self.location = location
+        self.image = image
+        self.size = size
+        self.count = count
+        self.volumes = volumes or []
+
+    def node_name(self, index):
+        return '%s-%d' % (self.name, index)
+
+    def index_of(self, node_name):
+        """Returns the index of a node of this group, or None."""
+        prefix = self.name + '-'
+        if node_name and node_name.startswith(prefix):
+            suffix = node_name[len(prefix):]
+            if suffix.isdigit():
+                return int(suffix)
+        return None
+
+    def parse_volume_tag(self, tag, group_names=()):
+        """
+        Returns the (node index, volume name) of a volume tag of this
+        group, or None.  Group names starting with this name are
+        ambiguous (the tag web-1-0-data may belong to the group web or
+        web-1), so a tag with a volume name that this group does not
+        declare is left to a longer group of group_names that matches
+        it.
+
+        """
+
+        parsed = _split_volume_tag(self.name, tag)
+        if parsed is None:
+            return None
+        if parsed[1] in [volume_name for volume_name, _ in self.volumes]:
+            return parsed
+        for name in group_names:
+            if (len(name) > len(self.name) and
+                    _split_volume_tag(name, tag) is not None):
+                return None
+        return parsed
+
+
+def _split_volume_tag(group_name, tag):
+    prefix = group_name + '-'
+    if not tag or not tag.startswith(prefix):
+        return None
+    index, _, volume_name = tag[len(prefix):].partition('-')
+    if not index.isdigit() or not volume_name:
+        return None
+    return int(index), volume_name
+
+
+def load_manifest(driver, manifest):
+    """
+    Returns the node groups of a manifest, given as a dictionary, a
+    file name, or a file-like object.  Locations and sizes are checked
+    against the configuration of the driver; a ValueError is raised
+    for invalid manifests.
+
+    """
+
+    if isinstance(manifest, basestring):
+        with open(manifest) as f:
+            manifest = json.load(f)
+    elif hasattr(manifest, 'read'):
+        manifest = json.load(manifest)
+
+    groups = []
+    seen = set()
+    for spec in manifest.get('groups', []):
+        try:
+            name = spec['name']
+            image_id = spec['image']
+            size_id = spec['size']
+        except KeyError as e:
+            raise ValueError('node group without %s' % e)
+
+        location_id = spec.get('location', driver.default_location.id)
+        try:
+            location = driver.locations[location_id]
+        except KeyError:
+            raise ValueError('unknown location %s in group %s' %
+                             (location_id, name))
+        size = driver.get_size(size_id)
+        if size is None:
+            raise ValueError('unknown size %s in group %s' % (size_id, name))
+
+        if (location.id, name) in seen:
+            raise ValueError('duplicate group %s at %s' % (name, location.id))
+        seen.add((location.id, name))
+
+        volumes = []
+        for volume in spec.get('volumes', []):
+            volumes.append((volume['name'], int(volume['size'])))
+
+        image = NodeImage(image_id, image_id, driver)
+        groups.append(NodeGroup(name, location, image, size,
+                                int(spec.get('count', 1)), volumes))
+
+    return groups
+
+
+class Step(object):
+    """One action of a plan."""
+
+    def __init__(self, action, location, target, **params):
+        self.action = action
+        self.location = location
+        self.target = target
+        self.params = params
+
+    def __str__(self):
+        return '%-14s %-24s at %s' % (self.action, self.target, self.location.id)
+
+
+class Plan(object):
+    """The steps leading from the current to the desired state."""
+
+    def __init__(self, steps, locations):
+        self.steps = steps
+        self.locations = locations
+
+    def __len__(self):
+        return len(self.steps)
+
+    def steps_for(self, action):
+        return [step for step in self.steps if step.action == action]
+
+    def estimated_backend_calls(self):
+        """
+        Returns the number of backend calls made to run the plan,
+        without retries and without the listings made while waiting
+        for new nodes to boot before attaching volumes.
+
+        """
+
+        return sum(BACKEND_CALLS[step.action] for step in self.steps)
+
+    def format(self):
+        lines = [str(step) for step in self.steps]
+        if not lines:
+            lines.append('nothing to do')
+        lines.append('')
+        lines.append('listing: %d backend calls (%d locations)' %
+                     (LISTING_CALLS * len(self.locations), len(self.locations)))
+        lines.append('plan: %d steps, about %d backend calls' %
+                     (len(self.steps), self.estimated_backend_calls()))
+        if self.steps_for(ATTACH_VOLUME):
+            lines.append('plus one listing per location and poll while '
+                         'waiting for new nodes before attaching volumes')
+        return '\n'.join(lines)
+
+
+def _shape(size):
+    """Returns the (cpu, ram, disk) of a size, or None if not integers."""
+    try:
+        return (int(getattr(size, 'cpu', 1)), int(size.ram), int(size.disk))
+    except (TypeError, ValueError):
+        return None
+
+
+class Reconciler(object):
+    """
+    Computes and runs the plans bringing the fleet of a driver to the
+    state of a manifest.  At most max_workers steps run at the same
+    time, and failed steps are retried up to retries times with an
+    exponential backoff.  New nodes are given boot_timeout seconds to
+    be running before their volumes are attached.
+
+    """
+
+    def __init__(self, driver, max_workers=8, retries=2, backoff=1.0,
+                 boot_timeout=900, poll_interval=10, prune_volumes=False):
+        self.driver = driver
+        self.max_workers = max_workers
+        self.retries = retries
+        self.backoff = backoff
+        self.boot_timeout = boot_timeout
+        self.poll_interval = poll_interval
+        self.prune_volumes = prune_volumes
+
+    def plan(self, groups):
+        """Returns the Plan for the given node groups."""
+
+        locations = {}
+        for group in groups:
+            locations[group.location.id] = group.location
+
+        # one listing pass per location, in parallel
+        location_list = locations.values()
+        listings = self.driver._pool.map(self._read_location, location_list)
+        state = {}
+        for location, future in zip(location_list, listings):
+            state[location.id] = future.result()
+
+        group_names = [group.name for group in groups]
+        steps = []
+        for group in groups:
+            nodes, volumes = state[group.location.id]
+            steps.extend(self._plan_group(group, nodes, volumes,
+                                          group_names))
+
+        steps.sort(key=lambda step: ACTIONS.index(step.action))
+        return Plan(steps, location_list)
+
+    def _read_location(self, location):
+        # always live: a stale inventory snapshot would lead to
+        # duplicate creations
+        nodes = []
+        for vm_info in self.driver._list_vm_infos_live(location):
+            node = self.driver._vm_info_to_node(vm_info, location)
+            if node.cached_state != NodeState.TERMINATED:
+                nodes.append(node)
+
+        volumes = {}
+        for info in self.driver._describe_volumes_live(location):
+            volume = self.driver._create_storage_volume(info, location)
+            volumes.setdefault(volume.name, volume)
+
+        return nodes, volumes
+
+    def _plan_group(self, group, nodes, volumes, group_names=()):
+        location = group.location
+
+        members = []
+        for node in nodes:
+            index = group.index_of(node.name)
+            if index is not None:
+                members.append((index, node))
+        members.sort(key=lambda member: (member[0], str(member[1].id)))
+
+        steps = []
+        kept = {}
+        for index, node in members:
+            if (index >= group.count or index in kept or
+                    node.cached_state not in _LIVE_STATES or
+                    node.image.id != group.image.id or
+                    _shape(node.size) is None or
+                    _shape(node.size) != _shape(group.size)):
+                steps.append(Step(DESTROY_NODE, location, node.name, node=node))
+            else:
+                kept[index] = node
+
+        for index in xrange(group.count):
+            node_name = group.node_name(index)
+            if index not in kept:
+                steps.append(Step(CREATE_NODE, location, node_name,
+                                  group=group))
+
+            for volume_name, size in group.volumes:
+                tag = '%s-%s' % (node_name, volume_name)
+                volume = volumes.get(tag)
+                if volume is None:
+                    steps.append(Step(CREATE_VOLUME, location, tag,
+                                      size=size))
+                if index not in kept or volume is None:
+                    steps.append(Step(ATTACH_VOLUME, location, tag,
+                                      node_name=node_name,
+                                      node=kept.get(index), volume=volume))
+
+        if self.prune_volumes:
+            wanted = [volume_name for volume_name, _ in group.volumes]
+            for tag, volume in volumes.items():
+                parsed = group.parse_volume_tag(tag, group_names)
+                if parsed is None:
+                    continue
+                index, volume_name = parsed
+                if index >= group.count or volume_name not in wanted:
+                    steps.append(Step(DESTROY_VOLUME, location, tag,
+                                      volume=volume))
+
+        return steps
+
+    def apply(self, plan):
+        """
+        Runs a plan and returns a list of (step, exception) tuples in
+        the order of the steps; the exception is None for the steps
+        that succeeded.
+
+        """
+
+        errors = {}
+        created_nodes = {}
+        created_volumes = {}
+
+        def run(action, fn):
+            steps = plan.steps_for(action)
+            results = self.driver._run_grouped(self._retrying(fn), steps,
+                                               lambda step: step.location,
+                                               self.max_workers)
+            succeeded = []
+            for step, (result, error) in zip(steps, results):
+                if error is None:
+                    succeeded.append((step, result))
+                else:
+                    log.warning('%s failed: %s', step, error)
+                    errors[id(step)] = error
+            return succeeded
+
+        run(DESTROY_NODE,
+            lambda step: self.driver.destroy_node(step.params['node']))
+        run(DESTROY_VOLUME,
+            lambda step: self.driver.destroy_volume(step.params['volume']))
+
+        for step, node in run(CREATE_NODE, self._create_node):
+            created_nodes[(step.location.id, step.target)] = node
+        for step, volume in run(CREATE_VOLUME, self._create_volume):
+            created_volumes[(step.location.id, step.target)] = volume
+
+        waiting = {}
+        for step in plan.steps_for(ATTACH_VOLUME):
+            key = (step.location.id, step.params['node_name'])
+            if key in created_nodes:
+                waiting[key] = created_nodes[key]
+        self._wait_running(waiting.values())
+
+        def attach(step):
+            node = (step.params['node'] or
+                    created_nodes.get((step.location.id,
+                                       step.params['node_name'])))
+            volume = (step.params['volume'] or
+                      created_volumes.get((step.location.id, step.target)))
+            if node is None or volume is None:
+                raise DependencyError('node or volume of %s was not created' %
+                                      step.target)
+            return self.driver.attach_volume(node, volume)
+
+        run(ATTACH_VOLUME, attach)
+
+        return [(step, errors.get(id(step))) for step in plan.steps]
+
+    def _create_node(self, step):
+        group = step.params['group']
+        return self.driver.create_node(name=step.target, size=group.size,
+                                       image=group.image,
+                                       location=step.location)
+
+    def _create_volume(self, step):
+        return self.driver.create_volume(step.params['size'], step.target,
+                                         location=step.location)
+
+    def _retrying(self, fn):
+        def call(step):
+            attempt = 0
+            while True:
+                try:
+                    return fn(step)
+                except Exception as e:
+                    # a mutation that may have succeeded is left to the
+                    # next run rather than repeated
+                    if (attempt >= self.retries or
+                            isinstance(e, (DependencyError,
+                                           OutcomeUnknownError))):
+                        raise
+                    delay = random.uniform(0, self.backoff * 2 ** attempt)
+                    log.warning('%s failed, retrying in %.1f s: %s',
+                                step, delay, e)
+                    time.sleep(delay)
+                    attempt += 1
+        return call
+
+    def _wait_running(self, nodes):
+        """Waits until the given nodes are running or the timeout."""
+
+        pending = {}
+        for node in nodes:
+            pending.setdefault(node.extra['location'], set()).add(str(node.id))
+
+        deadline = time.time() + self.boot_timeout
+        while pending and time.time() < deadline:
+            for location in pending.keys():
+                try:
+                    vm_infos = self.driver._list_vm_infos_live(location)
+                except Exception as e:
+                    log.warning('cannot list nodes at %s: %s', location.id, e)
+                    continue
+                for vm_info in vm_infos:
+                    attrs = vm_info.getAttributes()
+                    state = self.driver._to_node_state(attrs.get('state_summary'))
+                    if state == NodeState.RUNNING:
+                        pending[location].discard(str(attrs.get('id')))
+                if not pending[location]:
+                    del pending[location]
+            if pending:
+                time.sleep(self.poll_interval)
+
+        for location, node_ids in pending.items():
+            log.warning('nodes %s at %s are not running after %d s',
+                        ', '.join(sorted(node_ids)), location.id,
+                        self.boot_timeout)
+
+
+def reconcile(driver, manifest, dry_run=False, **kwargs):
+    """
+    Brings the fleet to the state described by the manifest (see
+    load_manifest) and returns the plan together with the (step,
+    exception) results, which are None for a dry run.  The keyword
+    arguments are passed to the Reconciler.
+
+    """
+
+    reconciler = Reconciler(driver, **kwargs)
+    plan = reconciler.plan(load_manifest(driver, manifest))
+    if dry_run:
+        return plan, None
+    return plan, reconciler.apply(plan)
+
+
+def main(argv=None):
+    parser = OptionParser(usage='%prog [options] manifest.json',
+                          description='Brings the StratusLab nodes and '
+                                      'volumes to the state described by '
+                                      'a JSON manifest.')
+    parser.add_option('--config', dest='config', default=None,
+                      help='StratusLab user configuration file')
+    parser.add_option('--dry-run', dest='dry_run', action='store_true',
+                      default=False,
+                      help='show the plan and the estimated backend calls')
+    parser.add_option('--max-workers', dest='max_workers', type='int',
+                      default=8, help='steps run at the same time')
+    parser.add_option('--retries', dest='retries', type='int', default=2,
+                      help='retries of a failed step (default 2)')
+    parser.add_option('--boot-timeout', dest='boot_timeout', type='float',
+                      default=900,
+                      help='seconds to wait for new nodes before '
+                           'attaching volumes (default 900)')
+    parser.add_option('--prune-volumes', dest='prune_volumes',
+                      action='store_true', default=False,
+                      help='destroy the volumes of removed nodes')
+
+    options, args = parser.parse_args(argv)
+    if len(args) != 1:
+        parser.error('a single manifest is required')
+
+    logging.basicConfig()
+
+    driver = get_driver_instance(options.config)
+
+    try:
+        plan, results = reconcile(driver, args[0], dry_run=options.dry_run,
+                                  max_workers=options.max_workers,
+                                  retries=options.retries,
+                                  boot_timeout=options.boot_timeout,
+                                  prune_volumes=options.prune_volumes)
+    except ValueError as e:
+        parser.error(str(e))
+
+    print plan.format()
+    if results is None:
+        return 0
+
+    failed = [step for step, error in results if error is not None]
+    print '%d steps done, %d failed' % (len(results) - len(failed), len(failed))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
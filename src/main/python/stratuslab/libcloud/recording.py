@@ -0,0 +1,289 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Record and replay of the backend traffic of the StratusLab driver.
+
+ A RecordingBackend wraps another backend (by default the real
+ services) and saves every call made on the Monitor, pdisk, and VM
+ manager clients, and every Marketplace download, together with its
+ arguments, result (or exception), and latency.  A ReplayBackend
+ serves the recorded results back, sleeping for the recorded latency
+ multiplied by a speed factor (0 disables the sleeps).
+
+ driver = StratusLabNodeDriver('unused-key',
+                               stratuslab_record='traffic.rec')
+ ...
+ driver.backend.close()
+
+ driver = StratusLabNodeDriver('unused-key',
+                               stratuslab_replay='traffic.rec',
+                               stratuslab_replay_speed=0.5)
+
+ Recordings are gzip-compressed streams of pickled records.  During
+ replay, the calls with the same location, client, method, and
+ arguments are served in the recorded order; once they are exhausted
+ the last recorded result is repeated.
+
+"""
+
+import atexit
+import cPickle as pickle
+import gzip
+import logging
+import threading
+import time
+from StringIO import StringIO
+
+from stratuslab.libcloud.backend import DirectBackend
+
+log = logging.getLogger(__name__)
+
+FORMAT_VERSION = 1
+
+MONITOR = 'monitor'
+VOLUME_MANAGER = 'pdisk'
+VM_MANAGER = 'runner'
+URL = 'url'
+
+
+class ReplayError(KeyError):
+    """Raised when a call to replay was never recorded."""
+    pass
+
+
+class RecordedError(Exception):
+    """Stands in for a recorded exception that could not be pickled."""
+    pass
+
+
+def _call_key(location_id, kind, method, args):
+    # arguments may contain unhashable values (e.g. filter dicts)
+    return (location_id, kind, method, repr(args))
+
+
+class _RecordingProxy(object):
+    """Forwards method calls to the target and records them."""
+
+    def __init__(self, backend, location_id, kind, target):
+        self._backend = backend
+        self._location_id = location_id
+        self._kind = kind
+        self._target = target
+
+    def __getattr__(self, name):
+        value = getattr(self._target, name)
+        if not callable(value):
+            return value
+
+        def call(*args):
+            return self._backend._record_call(self._location_id, self._kind,
+                                              name, value, args)
+
+        return call
+
+
+class RecordingBackend(object):
+    """
+    Backend that records all of the traffic passing through the
+    wrapped backend into the given file.  close() must be called to
+    complete the recording; this is also done at interpreter exit.
+
+    """
+
+    def __init__(self, path, backend=None):
+        self.path = path
+        self._backend = backend or DirectBackend()
+
+        self._lock = threading.Lock()
+        self._file = gzip.open(path, 'wb')
+        self._start = time.time()
+        self._count = 0
+
+        pickle.dump(('stratuslab-recording', FORMAT_VERSION, self._start),
+                    self._file, pickle.HIGHEST_PROTOCOL)
+
+        atexit.register(self.close)
+
+    def create_monitor(self, location_id, config_holder):
+        client = self._backend.create_monitor(location_id, config_holder)
+        return _RecordingProxy(self, location_id, MONITOR, client)
+
+    def create_volume_manager(self, location_id, config_holder):
+        client = self._backend.create_volume_manager(location_id, config_holder)
+        return _RecordingProxy(self, location_id, VOLUME_MANAGER, client)
+
+    def create_vm_manager(self, location_id, image_id, config_holder):
+        client = self._backend.create_vm_manager(location_id, image_id,
+                                                 config_holder)
+        return _RecordingProxy(self, location_id, VM_MANAGER, client)
+
+    def open_url(self, location_id, url):
+        def read(url):
+            f = self._backend.open_url(location_id, url)
+            try:
+                return f.read()
+            finally:
+                f.close()
+
+        content = self._record_call(location_id, URL, 'read', read, (url,))
+        return StringIO(content)
+
+    def _record_call(self, location_id, kind, method, fn, args):
+        start = time.time()
+        try:
+            result = fn(*args)
+        except Exception as e:
+            self._write(start, location_id, kind, method, args, None, e)
+            raise
+        self._write(start, location_id, kind, method, args, result, None)
+        return result
+
+    def _write(self, start, location_id, kind, method, args, result, error):
+        latency = time.time() - start
+        record = (start - self._start, location_id, kind, method, args,
+                  result, error, latency)
+
+        with self._lock:
+            if self._file is None:
+                return
+            try:
+                data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+            except (pickle.PicklingError, TypeError):
+                if error is None:
+                    log.warning('cannot record result of %s.%s', kind, method)
+                    return
+                error = RecordedError('%s: %s' % (error.__class__.__name__,
+                                                  error))
+                record = record[:6] + (error, latency)
+                data = pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+            self._file.write(data)
+            self._count += 1
+
+    def close(self):
+        """Completes the recording and returns the number of calls."""
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            return self._count
+
+
+def read_recording(path):
+    """
+    Iterates over the records of a recording.  Each record is a tuple
+    (start offset, location id, client kind, method, arguments,
+    result, exception, latency).
+
+    """
+
+    f = gzip.open(path, 'rb')
+    try:
+        header = pickle.load(f)
+        if header[0] != 'stratuslab-recording' or header[1] != FORMAT_VERSION:
+            raise ValueError('%s is not a supported recording' % path)
+        while True:
+            try:
+                yield pickle.load(f)
+            except EOFError:
+                break
+    finally:
+        f.close()
+
+
+class _ReplayProxy(object):
+    """Serves the recorded results of the method calls made on it."""
+
+    def __init__(self, backend, location_id, kind):
+        self._backend = backend
+        self._location_id = location_id
+        self._kind = kind
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+
+        def call(*args):
+            return self._backend._replay_call(self._location_id, self._kind,
+                                              name, args)
+
+        return call
+
+
+class ReplayBackend(object):
+    """
+    Backend serving the calls saved by a RecordingBackend.  The
+    recorded latencies are multiplied by speed before sleeping: 1.0
+    preserves them, 0 replays as fast as possible.
+
+    """
+
+    def __init__(self, path, speed=1.0):
+        self.path = path
+        self.speed = speed
+
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._misses = 0
+        self._replayed = 0
+
+        for record in read_recording(path):
+            _, location_id, kind, method, args, result, error, latency = record
+            key = _call_key(location_id, kind, method, args)
+            self._calls.setdefault(key, []).append((result, error, latency))
+
+    def create_monitor(self, location_id, config_holder):
+        return _ReplayProxy(self, location_id, MONITOR)
+
+    def create_volume_manager(self, location_id, config_holder):
+        return _ReplayProxy(self, location_id, VOLUME_MANAGER)
+
+    def create_vm_manager(self, location_id, image_id, config_holder):
+        return _ReplayProxy(self, location_id, VM_MANAGER)
+
+    def open_url(self, location_id, url):
+        return StringIO(self._replay_call(location_id, URL, 'read', (url,)))
+
+    def _replay_call(self, location_id, kind, method, args):
+        key = _call_key(location_id, kind, method, args)
+
+        with self._lock:
+            outcomes = self._calls.get(key)
+            if not outcomes:
+                self._misses += 1
+                raise ReplayError('no recorded call for %s.%s%r at %s' %
+                                  (kind, method, args, location_id))
+            if len(outcomes) > 1:
+                result, error, latency = outcomes.pop(0)
+            else:
+                result, error, latency = outcomes[0]
+            self._replayed += 1
+
+        if self.speed:
+            time.sleep(latency * self.speed)
+
+        if error is not None:
+            raise error
+        return result
+
+    def stats(self):
+        """
+        Returns the number of calls replayed ('replayed') and the
+        number of calls that were not recorded ('misses').
+
+        """
+
+        with self._lock:
+            return {'replayed': self._replayed, 'misses': self._misses}
@@ -0,0 +1,252 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Resilience policies for calls to StratusLab backends.
+
+ Each location has its own policy combining a call deadline, a
+ bounded number of retries with exponential backoff, and a circuit
+ breaker.  Retries are drawn from a retry budget shared by all of
+ the locations of a driver, so that a misbehaving site cannot
+ multiply the load on the other ones.
+
+"""
+
+import logging
+import random
+import threading
+import time
+
+from stratuslab.libcloud.executor import TimeoutError
+
+log = logging.getLogger(__name__)
+
+
+class CircuitOpenError(Exception):
+    """Raised without calling the backend when a circuit is open."""
+    pass
+
+
+class DeadlineExceededError(Exception):
+    """Raised when a backend call does not finish before its deadline."""
+    pass
+
+
+class OutcomeUnknownError(DeadlineExceededError):
+    """
+    Raised when a call changing the state of the cloud does not finish
+    before its deadline.  The call keeps running and may still
+    succeed, so it must not be repeated blindly.
+
+    """
+    pass
+
+
+class RetryBudget(object):
+    """
+    Token bucket limiting the number of retries.  Every first attempt
+    deposits 'ratio' tokens and every retry withdraws one token.  The
+    bucket starts with (and never holds fewer tokens than are needed
+    for) min_retries retries and is capped at max_tokens.
+
+    """
+
+    def __init__(self, ratio=0.2, min_retries=10, max_tokens=100):
+        self.ratio = ratio
+        self.max_tokens = max_tokens
+        self._lock = threading.Lock()
+        self._tokens = float(min_retries)
+
+    def deposit(self):
+        with self._lock:
+            self._tokens = min(self.max_tokens, self._tokens + self.ratio)
+
+    def withdraw(self):
+        """Returns True if a retry may be made."""
+        with self._lock:
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return True
+            return False
+
+    @property
+    def tokens(self):
+        return self._tokens
+
+
+class CircuitBreaker(object):
+    """
+    Classic three-state circuit breaker.  After failure_threshold
+    consecutive failures the circuit opens and calls fail fast.  Once
+    reset_timeout seconds have passed, a single probe call is allowed
+    through (half-open); its outcome closes or re-opens the circuit.
+
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self._lock = threading.Lock()
+        self._state = CircuitBreaker.CLOSED
+        self._failures = 0
+        self._opened_at = None
+
+    @property
+    def state(self):
+        with self._lock:
+            if (self._state == CircuitBreaker.OPEN and
+                    time.time() - self._opened_at >= self.reset_timeout):
+                return CircuitBreaker.HALF_OPEN
+            return self._state
+
+    def is_open(self):
+        """True if calls are currently rejected without a probe."""
+        return self.state == CircuitBreaker.OPEN
+
+    def allow(self):
+        """
+        Returns True if a call may be made.  When the reset timeout
+        has expired, only the first caller is allowed through as a
+        probe.
+
+        """
+
+        with self._lock:
+            if self._state == CircuitBreaker.CLOSED:
+                return True
+            if self._state == CircuitBreaker.OPEN:
+                if time.time() - self._opened_at >= self.reset_timeout:
+                    self._state = CircuitBreaker.HALF_OPEN
+                    return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = CircuitBreaker.CLOSED
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            if (self._state == CircuitBreaker.HALF_OPEN or
+                    self._failures >= self.failure_threshold):
+                self._state = CircuitBreaker.OPEN
+                self._opened_at = time.time()
+
+
+class ResiliencePolicy(object):
+    """
+    Deadline, retry, and circuit-breaker policy for one location.
+
+    Calls with a deadline run on the given thread pool; the caller
+    stops waiting when the deadline expires, leaving the hung call to
+    finish (or not) in its worker thread.  Queries use the timeout
+    deadline.  Calls changing the state of the cloud (call_once) use
+    the separate mutation_timeout, which is disabled by default: such
+    calls run in the calling thread until they finish.
+
+    """
+
+    def __init__(self, name, pool, budget, timeout=60, max_retries=2,
+                 backoff=0.5, max_backoff=10, failure_threshold=5,
+                 reset_timeout=30, mutation_timeout=0):
+        self.name = name
+        self.timeout = timeout
+        self.mutation_timeout = mutation_timeout
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+        self._pool = pool
+        self._budget = budget
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Calls fn(*args, **kwargs), retrying failures up to max_retries
+        times while the retry budget allows it.  Use call_once() for
+        operations that must not be repeated.
+
+        """
+
+        return self._call(True, self.timeout, fn, args, kwargs)
+
+    def call_once(self, fn, *args, **kwargs):
+        """
+        Calls fn(*args, **kwargs) under the circuit breaker and the
+        mutation deadline, without retries.  If the deadline expires,
+        OutcomeUnknownError is raised and the circuit breaker is not
+        updated, since the call may still succeed.
+
+        """
+
+        return self._call(False, self.mutation_timeout, fn, args, kwargs)
+
+    def _call(self, retry, timeout, fn, args, kwargs):
+        self._budget.deposit()
+
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                raise CircuitOpenError('circuit open for location %s' % self.name)
+
+            try:
+                result = self._call_with_deadline(timeout, fn, args, kwargs)
+            except Exception as e:
+                if not retry and isinstance(e, DeadlineExceededError):
+                    # The mutation may still succeed, so this is not a
+                    # failure, but a half-open probe must not stay
+                    # pending forever.
+                    if self.breaker.state == CircuitBreaker.HALF_OPEN:
+                        self.breaker.record_failure()
+                    raise OutcomeUnknownError('call to location %s exceeded %s s '
+                                              'deadline; its outcome is unknown' %
+                                              (self.name, timeout))
+                self.breaker.record_failure()
+
+                if not (retry and attempt < self.max_retries and
+                        self._budget.withdraw()):
+                    raise
+
+                delay = self._backoff_delay(attempt)
+                log.warning('%s: retrying in %.2f s after error: %s',
+                            self.name, delay, e)
+                time.sleep(delay)
+                attempt += 1
+            else:
+                self.breaker.record_success()
+                return result
+
+    def _call_with_deadline(self, timeout, fn, args, kwargs):
+        if not timeout:
+            return fn(*args, **kwargs)
+
+        future = self._pool.submit(fn, *args, **kwargs)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            raise DeadlineExceededError('call to location %s exceeded %s s deadline' %
+                                        (self.name, timeout))
+
+    def _backoff_delay(self, attempt):
+        # full jitter: uniform in [0, min(max_backoff, backoff * 2^attempt)]
+        ceiling = min(self.max_backoff, self.backoff * (2 ** attempt))
+        return random.uniform(0, ceiling)
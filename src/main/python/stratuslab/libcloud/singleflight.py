@@ -0,0 +1,106 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Request coalescing ("single-flight") for backend queries.
+
+ When several threads ask for the same thing at the same time, only
+ the first one (the leader) actually calls the backend.  The other
+ threads wait for the leader to finish and then receive the same
+ result, or the same exception.  Nothing is cached: once the leader
+ has finished, the next call for the same key goes to the backend
+ again.
+
+"""
+
+import sys
+import threading
+
+
+class _Call(object):
+    """
+    State of a single in-flight call shared between the leader
+    and all of the waiting callers.
+
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.exc_info = None
+
+
+class SingleFlight(object):
+    """
+    Coalesces concurrent calls that share the same key.  Keys must
+    be hashable; the driver uses (operation, location, arguments).
+
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self._total = 0
+        self._coalesced = 0
+
+    def do(self, key, fn, *args, **kwargs):
+        """
+        Calls fn(*args, **kwargs) unless a call with the same key is
+        already in flight, in which case the result (or exception)
+        of that call is returned (or raised) instead.
+
+        """
+
+        with self._lock:
+            self._total += 1
+            call = self._calls.get(key)
+            if call is None:
+                call = _Call()
+                self._calls[key] = call
+                leader = True
+            else:
+                self._coalesced += 1
+                leader = False
+
+        if not leader:
+            call.done.wait()
+            if call.exc_info is not None:
+                raise call.exc_info[0], call.exc_info[1], call.exc_info[2]
+            return call.result
+
+        try:
+            call.result = fn(*args, **kwargs)
+            return call.result
+        except:
+            call.exc_info = sys.exc_info()
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+    def stats(self):
+        """
+        Returns a dictionary with the total number of calls made
+        through this object ('calls'), the number of calls that were
+        served by another in-flight call ('coalesced') and the number
+        of calls currently in flight ('in_flight').
+
+        """
+
+        with self._lock:
+            return {'calls': self._total,
+                    'coalesced': self._coalesced,
+                    'in_flight': len(self._calls)}
@@ -0,0 +1,338 @@
+#
+# Copyright (c) 2013, Centre National de la Recherche Scientifique (CNRS)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+"""
+Warm pool of pre-booted StratusLab nodes.
+
+ Booting a machine takes minutes.  A warm pool keeps a number of
+ RUNNING spare nodes for given (location, image, size) combinations;
+ create_node() hands one of them out immediately when a request
+ matches.  A background thread boots replacements, follows booting
+ spares until they are running, drops ready spares that are no longer
+ running, and recycles spares that stayed idle for longer than the
+ TTL.  A spare is also checked to be running before it is handed out.
+
+ pool = driver.enable_warm_pool([(location, image, size, 2)], ttl=3600)
+ ...
+ print pool.stats()
+
+ StratusLab cannot rename a machine, so the name requested from
+ create_node() is only set on the returned Node object; the name of
+ the machine in the cloud is kept in extra['warm_pool_name'].
+
+"""
+
+import logging
+import threading
+import time
+import uuid
+
+from libcloud.compute.types import NodeState
+
+log = logging.getLogger(__name__)
+
+
+class _Spare(object):
+
+    def __init__(self, node, launched_at):
+        self.node = node
+        self.launched_at = launched_at
+        self.ready_at = None
+
+    @property
+    def boot_latency(self):
+        return self.ready_at - self.launched_at
+
+
+class WarmPool(object):
+    """
+    Pool of spare nodes for the given targets, a list of (location,
+    image, size, count) tuples.  Spares are booted with the given
+    authentication (by default the key configured for the user).  A
+    request is only served from the pool when it asks for the same
+    authentication: the same public key, or none at all when the pool
+    uses the configured key.
+
+    """
+
+    def __init__(self, driver, targets, auth=None, ttl=3600,
+                 refill_interval=30, boot_timeout=900, name_prefix='warm-'):
+        self.driver = driver
+        self.auth = auth
+        self.ttl = ttl
+        self.refill_interval = refill_interval
+        self.boot_timeout = boot_timeout
+        self.name_prefix = name_prefix
+
+        self._targets = {}
+        for location, image, size, count in targets:
+            location = location or driver.default_location
+            key = (location.id, image.id, size.id)
+            self._targets[key] = (location, image, size, count)
+
+        self._lock = threading.Lock()
+        self._ready = {}
+        self._booting = {}
+        for key in self._targets:
+            self._ready[key] = []
+            self._booting[key] = []
+
+        self._hits = 0
+        self._misses = 0
+        self._latency_saved = 0.0
+
+        self._wake = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    def start(self):
+        """Starts the background thread that maintains the pool."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run,
+                                            name='stratuslab-warm-pool')
+            self._thread.setDaemon(True)
+            self._thread.start()
+
+    def stop(self, destroy_spares=True):
+        """
+        Stops the background thread and, by default, destroys the
+        spare nodes (booting or ready).
+
+        """
+
+        self._stopped.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+        if destroy_spares:
+            with self._lock:
+                spares = []
+                for key in self._targets:
+                    spares.extend(self._ready[key])
+                    spares.extend(self._booting[key])
+                    self._ready[key] = []
+                    self._booting[key] = []
+            for spare in spares:
+                self._destroy(spare)
+
+    def _matches_auth(self, auth):
+        if auth is None or self.auth is None:
+            # no auth means the key of the user configuration
+            return auth is None and self.auth is None
+        return getattr(auth, 'pubkey', None) == getattr(self.auth, 'pubkey', None)
+
+    def acquire(self, location, image, size, name, auth=None):
+        """
+        Returns a running spare node matching the request, renamed to
+        the given name, or None if there is none.  Every call counts
+        as a hit or a miss.
+
+        """
+
+        location = location or self.driver.default_location
+        key = (location.id, image.id, getattr(size, 'id', None))
+
+        while True:
+            with self._lock:
+                spares = self._ready.get(key)
+                if not spares or not self._matches_auth(auth):
+                    self._misses += 1
+                    return None
+                spare = spares.pop(0)
+
+            # the spare may have been killed outside of the pool
+            try:
+                state = spare.node.get_node_state()
+            except ValueError:
+                log.warning('warm pool spare %s has disappeared', spare.node.id)
+                self._wake.set()
+                continue
+            except Exception as e:
+                log.warning('cannot check warm pool spare %s: %s',
+                            spare.node.id, e)
+                with self._lock:
+                    self._ready[key].insert(0, spare)
+                    self._misses += 1
+                return None
+
+            if state == NodeState.RUNNING:
+                break
+
+            log.warning('warm pool spare %s is no longer running', spare.node.id)
+            self._wake.set()
+            self._destroy(spare)
+
+        with self._lock:
+            self._hits += 1
+            self._latency_saved += spare.boot_latency
+
+        # boot the replacement right away
+        self._wake.set()
+
+        node = spare.node
+        node.extra['warm_pool_name'] = node.name
+        node.name = name
+        return node
+
+    def stats(self):
+        """
+        Returns a dictionary with the number of requests served from
+        the pool ('hits') and not ('misses'), the hit rate, the total
+        boot time saved in seconds ('latency_saved'), and the number
+        of spares that are ready and booting.
+
+        """
+
+        with self._lock:
+            requests = self._hits + self._misses
+            hit_rate = float(self._hits) / requests if requests else 0.0
+            return {'hits': self._hits,
+                    'misses': self._misses,
+                    'hit_rate': hit_rate,
+                    'latency_saved': self._latency_saved,
+                    'ready': sum(len(spares) for spares in self._ready.values()),
+                    'booting': sum(len(spares) for spares in self._booting.values())}
+
+    def _run(self):
+        while not self._stopped.isSet():
+            try:
+                self.refill()
+            except Exception as e:
+                log.warning('warm pool maintenance failed: %s', e)
+            self._wake.wait(self.refill_interval)
+            self._wake.clear()
+
+    def refill(self):
+        """
+        Runs one maintenance cycle: recycles expired spares, promotes
+        booted spares, and boots the missing ones.  Called
+        periodically by the background thread.
+
+        """
+
+        now = time.time()
+        self._reap(now)
+        self._check_spares(now)
+        self._launch_missing()
+
+    def _reap(self, now):
+        if not self.ttl:
+            return
+
+        expired = []
+        with self._lock:
+            for key in self._targets:
+                fresh = []
+                for spare in self._ready[key]:
+                    if now - spare.ready_at > self.ttl:
+                        expired.append(spare)
+                    else:
+                        fresh.append(spare)
+                self._ready[key] = fresh
+
+        for spare in expired:
+            self._destroy(spare)
+
+    def _check_spares(self, now):
+        with self._lock:
+            locations = {}
+            for key, (location, _, _, _) in self._targets.items():
+                if self._booting[key] or self._ready[key]:
+                    locations[location.id] = location
+
+        for location in locations.values():
+            try:
+                vm_infos = self.driver.list_vm_infos(location)
+            except Exception as e:
+                log.warning('cannot check warm pool spares at %s: %s',
+                            location.id, e)
+                continue
+
+            states = {}
+            for vm_info in vm_infos:
+                attrs = vm_info.getAttributes()
+                states[str(attrs.get('id'))] = \
+                    self.driver._to_node_state(attrs.get('state_summary'))
+
+            self._update_spares(location.id, states, now)
+
+    def _update_spares(self, location_id, states, now):
+        failed = []
+        lost = []
+        with self._lock:
+            for key in self._targets:
+                if key[0] != location_id:
+                    continue
+
+                ready = []
+                for spare in self._ready[key]:
+                    if states.get(str(spare.node.id)) == NodeState.RUNNING:
+                        ready.append(spare)
+                    else:
+                        lost.append(spare)
+                self._ready[key] = ready
+
+                booting = []
+                for spare in self._booting[key]:
+                    state = states.get(str(spare.node.id))
+                    if state == NodeState.RUNNING:
+                        spare.ready_at = now
+                        spare.node.state = NodeState.RUNNING
+                        self._ready[key].append(spare)
+                    elif now - spare.launched_at > self.boot_timeout:
+                        failed.append(spare)
+                    else:
+                        booting.append(spare)
+                self._booting[key] = booting
+
+        for spare in failed:
+            log.warning('warm pool spare %s did not boot', spare.node.id)
+            self._destroy(spare)
+        for spare in lost:
+            log.warning('warm pool spare %s is no longer running', spare.node.id)
+            self._destroy(spare)
+
+    def _launch_missing(self):
+        launches = []
+        with self._lock:
+            for key, (location, image, size, count) in self._targets.items():
+                missing = count - len(self._ready[key]) - len(self._booting[key])
+                for _ in xrange(missing):
+                    launches.append((key, location, image, size))
+
+        for key, location, image, size in launches:
+            if self._stopped.isSet():
+                return
+            name = '%s%s' % (self.name_prefix, uuid.uuid4().hex[:8])
+            try:
+                node = self.driver._create_node(name=name, size=size,
+                                                image=image, location=location,
+                                                auth=self.auth)
+            except Exception as e:
+                log.warning('cannot boot warm pool spare at %s: %s',
+                            location.id, e)
+                continue
+
+            with self._lock:
+                self._booting[key].append(_Spare(node, time.time()))
+
+    def _destroy(self, spare):
+        try:
+            self.driver.destroy_node(spare.node)
+        except Exception as e:
+            log.warning('cannot destroy warm pool spare %s: %s',
+                        spare.node.id, e)
@@ -34,7 +34,7 @@ utils.print_objs(images[-5:])
 print
 
 # Large, node machine to run at GRNET.
-size = utils.select_id('m1.large', sizes)
+size = driver.get_size('m1.large')
 location = utils.select_id('grnet', locations)
 image = utils.select_id('BN1EEkPiBx87_uLj2-sdybSI-Xb', images)
 
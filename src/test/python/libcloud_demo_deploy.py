@@ -33,7 +33,7 @@ utils.print_objs(images[-5:])
 print
 
 # Large, ubuntu machine to run at GRNET.
-size = utils.select_id('m1.large', sizes)
+size = driver.get_size('m1.large')
 location = utils.select_id('lal', locations)
 image = utils.select_id('GJ5vp8gIxhZ1w1MQF16R6MIcNoq', images)
 
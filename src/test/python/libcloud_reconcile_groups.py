@@ -0,0 +1,48 @@
+import os
+import tempfile
+
+from stratuslab.libcloud.compute_driver import StratusLabNodeDriver
+from stratuslab.libcloud.loadgen import StubBackend, write_config
+from stratuslab.libcloud.reconcile import DESTROY_VOLUME, reconcile
+
+# Reconciles groups whose names overlap (web and web-1) and checks
+# that pruning the volumes of one group leaves the other alone.
+
+fd, config_file = tempfile.mkstemp(suffix='.cfg')
+os.close(fd)
+write_config(config_file, 1)
+
+backend = StubBackend(latency=0, vms_per_location=0)
+driver = StratusLabNodeDriver('unused-key',
+                              stratuslab_user_config=config_file,
+                              stratuslab_backend=backend)
+os.remove(config_file)
+
+manifest = {'groups': [{'name': 'web', 'location': 'loc0', 'image': 'IMG',
+                        'size': 'm1.small', 'count': 2,
+                        'volumes': [{'name': 'data', 'size': 1}]},
+                       {'name': 'web-1', 'location': 'loc0', 'image': 'IMG',
+                        'size': 'm1.small', 'count': 1,
+                        'volumes': [{'name': 'data', 'size': 1}]}]}
+
+plan, results = reconcile(driver, manifest, poll_interval=0)
+assert not [error for _, error in results if error]
+
+tags = sorted(volume.name for volume in driver.list_volumes())
+print 'volumes:', tags
+assert tags == ['web-0-data', 'web-1-0-data', 'web-1-data']
+
+plan, _ = reconcile(driver, manifest, dry_run=True, prune_volumes=True)
+print plan.format()
+assert not plan.steps, 'volumes of overlapping groups are pruned'
+
+# a volume that no group declares is still pruned from its group
+driver.create_volume(1, 'web-0-old', location=driver.locations['loc0'])
+plan, _ = reconcile(driver, manifest, dry_run=True, prune_volumes=True)
+print plan.format()
+assert [(step.action, step.target) for step in plan.steps] == \
+    [(DESTROY_VOLUME, 'web-0-old')]
+
+driver.close()
+
+print 'OK'
@@ -0,0 +1,145 @@
+import os
+import tempfile
+import threading
+import time
+
+from stratuslab.libcloud.compute_driver import StratusLabNodeDriver
+from stratuslab.libcloud.loadgen import StubBackend, write_config
+
+# Shares one driver between many threads working on several locations
+# of the stub backend, and checks that every result belongs to the
+# location and node it was requested for, and that the threads do not
+# serialize on the driver.
+
+LOCATIONS = 4
+THREADS = 32
+ROUNDS = 20
+
+fd, config_file = tempfile.mkstemp(suffix='.cfg')
+os.close(fd)
+write_config(config_file, LOCATIONS)
+
+backend = StubBackend(latency=0.005, vms_per_location=20, seed=1)
+driver = StratusLabNodeDriver('unused-key',
+                              stratuslab_user_config=config_file,
+                              stratuslab_backend=backend)
+
+locations = sorted(driver.list_locations(), key=lambda location: location.id)
+
+# machines of each location according to the backend
+expected = {}
+for location in locations:
+    expected[location.id] = backend.vms(location.id)
+
+start = threading.Event()
+errors = []
+created_tags = {}
+
+
+def check_nodes(location):
+    nodes = driver.list_nodes_in_location(location)
+    assert len(nodes) == len(expected[location.id]), \
+        'wrong node count at %s' % location.id
+    for node in nodes:
+        assert node.extra['location'].id == location.id, \
+            'node %s of %s listed at %s' % (node.id, node.extra['location'].id,
+                                            location.id)
+        attrs = expected[location.id].get(str(node.id))
+        assert attrs is not None, \
+            'node %s is not at %s' % (node.id, location.id)
+        assert node.public_ips == [attrs['template_nic_ip']], \
+            'wrong address for node %s' % node.id
+        assert node.host == attrs['history_records_history_hostname'], \
+            'wrong host for node %s' % node.id
+        assert node.state == driver._to_node_state(attrs['state_summary']), \
+            'wrong state for node %s' % node.id
+
+
+def check_volume(location, tag):
+    volume = driver.create_volume(1, tag, location=location)
+    assert volume.extra['location'].id == location.id, \
+        'volume %s created at %s' % (tag, volume.extra['location'].id)
+    created_tags.setdefault(location.id, []).append(tag)
+
+
+def work(index):
+    start.wait()
+    try:
+        for i in xrange(ROUNDS):
+            location = locations[(index + i) % len(locations)]
+            check_nodes(location)
+            if i % 5 == 0:
+                check_volume(location, '%s-t%d-r%d' % (location.id, index, i))
+    except Exception as e:
+        errors.append('thread %d: %s' % (index, e))
+
+
+threads = [threading.Thread(target=work, args=(i,)) for i in xrange(THREADS)]
+for thread in threads:
+    thread.start()
+start.set()
+for thread in threads:
+    thread.join()
+
+os.remove(config_file)
+
+for error in errors:
+    print error
+assert not errors, '%d threads failed' % len(errors)
+
+# every volume was created at the location it was requested for
+for location in locations:
+    tags = sorted(volume.name for volume in driver.list_volumes(location))
+    assert tags == sorted(created_tags.get(location.id, [])), \
+        'wrong volumes at %s' % location.id
+    for volume in driver.list_volumes(location):
+        assert volume.extra['location'].id == location.id
+
+stats = driver.get_coalescing_stats()
+backend_stats = backend.stats()
+print 'coalescing:', stats
+print 'backend calls:', backend_stats
+
+# each query is either a backend call or shares one in flight
+queries = backend_stats['listVms'] + backend_stats['vmDetail'] + \
+    backend_stats['describeVolumes']
+assert stats['in_flight'] == 0
+assert stats['calls'] == queries + stats['coalesced'], \
+    'coalescing counts do not match the backend calls'
+assert stats['coalesced'] > 0, 'no concurrent queries were coalesced'
+
+# Throughput: reading the hosts of all nodes (one distinct backend
+# query each, so nothing is coalesced) with N threads should take
+# about 1/N of the time taken by a single thread.
+
+
+def read_hosts(nodes):
+    for node in nodes:
+        node.host
+
+
+def timed_run(nodes, threads):
+    parts = [nodes[i::threads] for i in xrange(threads)]
+    workers = [threading.Thread(target=read_hosts, args=(part,))
+               for part in parts]
+    started = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.time() - started
+
+all_nodes = []
+for location in locations:
+    all_nodes.extend(driver.list_nodes_in_location(location))
+
+serial = timed_run(all_nodes, 1)
+parallel = timed_run(all_nodes, 8)
+speedup = serial / parallel
+print 'serial: %.2f s, 8 threads: %.2f s, speedup: %.1f' % (serial, parallel,
+                                                           speedup)
+assert speedup >= 4, 'threads are serialized (speedup %.1f)' % speedup
+
+driver.close()
+
+print 'OK'